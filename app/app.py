@@ -5,6 +5,8 @@ from pathlib import Path
 # From local files
 from app_server import server
 from app_ui import app_ui
+from app_instrumentation import profiling_enabled
+from app_variables import running_in_pyodide
 
 # Static assets directory containing .js and .css files
 www_dir = Path(__file__).parent 
@@ -15,3 +17,15 @@ app = App(app_ui,
           static_assets=www_dir
           )
 
+# Profiling timings as JSON at /profiling.json when profiling is enabled on a Shiny server (not available in the browser)
+if profiling_enabled and not running_in_pyodide:
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Mount, Route
+    from app_data_processing import get_profiling_report
+
+    shiny_app = app
+    app = Starlette(routes=[
+        Route("/profiling.json", lambda request: JSONResponse(get_profiling_report())),
+        Mount("/", app=shiny_app),
+    ])
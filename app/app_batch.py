@@ -0,0 +1,152 @@
+# Python modules
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# From local files
+import app_data_processing
+import app_disk_cache
+from app_data_processing import get_local_data, get_base_matrix, get_layout, get_year_matrices
+from app_layouts import enumerate_category_subsets
+from app_plotting import colors_map
+from app_variables import diagnoses_categories_map, data_filename, data_year, entity_column, disk_cache_enabled, disk_cache_dir
+
+# Headless batch of layouts (embedding coordinates and cluster labels) for many category selections, without the Shiny app.
+# Gives the same layouts as the app (get_layout in app_data_processing.py, including the precomputed layouts file).
+# The selections are fitted by a pool of worker processes. The base matrix is built once by the calling process and stored
+# in the disk cache (app_disk_cache.py), which the workers load it from memory-mapped, so every worker shares the same pages.
+# If the disk cache is turned off, a temporary directory is used for the batch.
+#
+# Usage (from the repository root):
+#   python app/app_batch.py --depth 1 --output layouts.json                             # selections within 1 click of all/one category
+#   python app/app_batch.py --subsets subsets.json --num-groups 2 3 4 --years 2015 2021 --output layouts.parquet
+# where subsets.json is a list of selections, each a list of category names. Parquet output needs pyarrow or fastparquet
+
+# Selections per task sent to a worker - the fit of one selection only takes milliseconds
+tasks_chunk_size = 8
+
+# Checks the selections, numbers of clusters and years before any work is sent to the workers.
+# The matrices of other years are built here, so that the workers load them from the disk cache
+def check_batch(subsets, num_groups, years):
+    unknown_categories = sorted({category for subset in subsets for category in subset} - set(diagnoses_categories_map))
+    if unknown_categories:
+        raise ValueError(f"Unknown categories: {unknown_categories}")
+    if any(len(subset) == 0 for subset in subsets):
+        raise ValueError("Every selection needs at least one category")
+    if any(not 1 <= groups <= len(colors_map) for groups in num_groups):
+        raise ValueError(f"Numbers of clusters must be between 1 and {len(colors_map)}")
+
+    # The matrices of every year are only built if years other than data_year are requested
+    other_years = set(years) - {data_year}
+    if not other_years:
+        return
+
+    available_years = [int(year) for year in get_year_matrices(app_data_processing.data_df_cached)["years"]]
+    unknown_years = sorted(other_years - set(available_years))
+    if unknown_years:
+        raise ValueError(f"No data for the years {unknown_years} (available: {available_years[0]} to {available_years[-1]})")
+
+# Worker process start up - loads the raw data and the base matrix from the disk cache written by compute_layouts.
+# Nothing is loaded again if the worker was forked from the calling process after it loaded them
+def init_worker(data_path, cache_dir):
+    app_disk_cache.disk_cache_enabled, app_disk_cache.disk_cache_dir = True, cache_dir
+    get_base_matrix(get_local_data(data_path))
+
+# Layouts of one selection for every number of clusters and year (runs in a worker)
+def get_subset_layouts(task):
+    categories, num_groups, years = task
+    df = app_data_processing.data_df_cached
+
+    layouts = []
+    for year in years:
+        for groups in num_groups:
+            X_reduced, labels = get_layout(df, categories, groups, year)
+            layouts.append({"categories": categories, "num_groups": groups, "year": year,
+                            "coordinates": np.array(X_reduced, dtype=np.float64), "labels": np.array(labels, dtype=np.int64)})
+    return layouts
+
+# Layouts of every selection (a list of lists of category names) for every number of clusters and year, computed by
+# a pool of worker processes (workers=None uses every core). Returns the entity names and a list of layouts
+# (dicts of categories, num_groups, year, coordinates (entities x 2) and labels), in the order of the selections
+def compute_layouts(subsets, num_groups=[3], years=[data_year], workers=None, data_path=data_filename):
+    data_path = str(Path(__file__).parent / data_path)
+    subsets = [list(subset) for subset in subsets]
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        cache_dir = disk_cache_dir if disk_cache_enabled else temporary_dir
+
+        # Base matrix (and year matrices) built once and stored in the disk cache before the workers start
+        init_worker(data_path, cache_dir)
+        check_batch(subsets, num_groups, years)
+        entities = list(get_base_matrix(app_data_processing.data_df_cached)["countries"][entity_column])
+
+        tasks = [(subset, list(num_groups), list(years)) for subset in subsets]
+        if workers == 1:
+            results = map(get_subset_layouts, tasks)
+            return entities, [layout for layouts in results for layout in layouts]
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(data_path, cache_dir)) as executor:
+            results = executor.map(get_subset_layouts, tasks, chunksize=tasks_chunk_size)
+            return entities, [layout for layouts in results for layout in layouts]
+
+# Long table of layouts with one row per layout and entity
+def get_layouts_table(entities, layouts):
+    return pd.DataFrame({
+        "layout": np.repeat(np.arange(len(layouts)), len(entities)),
+        "categories": np.repeat(["; ".join(layout["categories"]) for layout in layouts], len(entities)),
+        "num_groups": np.repeat([layout["num_groups"] for layout in layouts], len(entities)),
+        "year": np.repeat([layout["year"] for layout in layouts], len(entities)),
+        entity_column: np.tile(entities, len(layouts)),
+        "x": np.concatenate([layout["coordinates"][:, 0] for layout in layouts]) if layouts else [],
+        "y": np.concatenate([layout["coordinates"][:, 1] for layout in layouts]) if layouts else [],
+        "label": np.concatenate([layout["labels"] for layout in layouts]) if layouts else [],
+    })
+
+# Writes the layouts as Parquet (long table, see get_layouts_table) if the path ends in .parquet, otherwise as JSON
+def write_layouts(path, entities, layouts):
+    if Path(path).suffix == ".parquet":
+        get_layouts_table(entities, layouts).to_parquet(path, index=False)
+        return
+
+    Path(path).write_text(json.dumps({
+        "entities": entities,
+        "layouts": [{"categories": layout["categories"],
+                     "num_groups": layout["num_groups"],
+                     "year": layout["year"],
+                     "x": layout["coordinates"][:, 0].tolist(),
+                     "y": layout["coordinates"][:, 1].tolist(),
+                     "labels": layout["labels"].tolist()}
+                    for layout in layouts],
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description="Layouts of many category selections, computed in parallel")
+    selections = parser.add_mutually_exclusive_group(required=True)
+    selections.add_argument("--subsets", help="JSON file with a list of selections, each a list of category names")
+    selections.add_argument("--depth", type=int, help="Every selection within DEPTH clicks of all or one category selected")
+    parser.add_argument("--num-groups", type=int, nargs="+", default=[3], help="Numbers of clusters")
+    parser.add_argument("--years", type=int, nargs="+", default=[data_year])
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: number of cores)")
+    parser.add_argument("--data", help="csv file of the data (default: the bundled data)")
+    parser.add_argument("--output", required=True, help="Output file - .parquet or .json")
+    args = parser.parse_args()
+
+    subsets = json.loads(Path(args.subsets).read_text()) if args.subsets else enumerate_category_subsets(args.depth)
+
+    start = time.perf_counter()
+    entities, layouts = compute_layouts(subsets, args.num_groups, args.years, args.workers,
+                                        os.path.abspath(args.data) if args.data else data_filename)
+    elapsed = time.perf_counter() - start
+
+    write_layouts(args.output, entities, layouts)
+    print(f"{len(layouts)} layouts of {len(subsets)} selections in {elapsed:.2f} s written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
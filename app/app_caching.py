@@ -0,0 +1,85 @@
+# Python modules
+from collections import OrderedDict
+import threading
+
+# Bounded least recently used (LRU) cache with hit/miss counters.
+# Once full, storing a new value drops the entry that was used longest ago.
+# Thread-safe so that a single cache can be shared by every session of a Shiny server process
+class LRUCache:
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._in_flight = {} # key -> threading.Event set once the value being computed for the key is stored
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    # Returns the cached value (marking it as recently used) or default if not cached
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # Returns the cached value, or computes it with compute_function() and caches it on a miss.
+    # Single-flight: if another thread is already computing the same key, waits for and reuses its result
+    def get_or_compute(self, key, compute_function):
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+
+                computing = self._in_flight.get(key)
+                if computing is None:
+                    self.misses += 1
+                    computing = threading.Event()
+                    self._in_flight[key] = computing
+                    break
+
+            # Another thread is computing the value - check the cache again once it is done (or failed)
+            computing.wait()
+
+        try:
+            value = compute_function()
+            self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            computing.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+# Makes a NumPy array read-only so that arrays shared between sessions cannot be modified in-place
+def make_read_only(array):
+    array.flags.writeable = False
+    return array
+
@@ -1,63 +1,168 @@
 # Python modules
 from pathlib import Path
+from io import BytesIO
+import asyncio
+import importlib
+import threading
+import numpy as np
 import pandas as pd
-import pyodide.http
-from io import StringIO
 import bqplot.pyplot as plt
 
 # From local files
-from app_variables import diagnoses_categories_map, diagnoses_categories_map_aggregates, data_url
-from app_plotting import create_plot, empty_plot_with_title
+from app_variables import diagnoses_categories_map, diagnoses_categories_map_aggregates, data_source, data_url, data_filename, data_encoding, model_backend
+from app_variables import entity_column, data_year, data_first_year, to_drop_entities, exact_layout_max_points
+from app_plotting import create_plot, empty_plot_with_title, fit_layout, fit_layout_from_distances, fit_layout_approximate
+from app_plotting import fit_layouts_from_distances, align_layouts
+from app_caching import LRUCache, make_read_only
+from app_numeric import impute_median_array, impute_median_batch, standard_scale, squared_distances
+from app_snapshot import get_snapshot_path, load_snapshot, is_snapshot_current
+from app_layouts import get_layouts_path, load_layouts, get_precomputed_layout, get_category_mask
+from app_disk_cache import get_cache_key, get_entry_path, load_entry, save_entry, get_or_compute, touch_cache_key
+from app_instrumentation import span, count, get_profile
+from app_fetch import fetch_and_parse_async, fetch_asset_and_parse_async
 
 # Global variable store of raw data
 data_df_cached = None
 
-# Fetch csv data from url and avoids additional http requests if cached data exists from previous call to function
-async def get_web_data_async(url):
+# Global variable store of the processed base matrix (see build_base_matrix)
+base_matrix_cached = None
+
+# Contents of the precomputed layouts file when it is fetched (see get_asset_data_async) - None uses the file next to data_filename
+precomputed_layouts_bytes = None
+
+# Set once the columns only used by the table have been loaded, see load_table_data_async
+table_data_loaded = False
+
+# The cached data and base matrix are shared by every session in the process (e.g. multiple users on a Shiny server).
+# Locks make loading single-flight: the first session loads/builds while concurrent sessions wait and reuse the result
+data_lock = threading.Lock()
+web_data_lock = asyncio.Lock()
+table_data_lock = asyncio.Lock()
+base_matrix_lock = threading.Lock()
+year_matrices_lock = threading.Lock()
+
+# Maximum number of category selection layouts memoized per base matrix
+layout_cache_size = 128
+
+# Modelling modules imported on first use rather than at start up - importing scikit-learn (and SciPy) takes
+# longer than loading the rest of the app, so the UI is shown before they are loaded.
+# The NumPy backend (app_numeric.py) does not need any. They are only imported with importlib.import_module, never with
+# import statements: Shinylive installs every package imported anywhere in the source before the app starts
+model_modules = ["sklearn.impute", "sklearn.preprocessing", "sklearn.manifold", "sklearn.cluster"] if model_backend == "sklearn" else []
+
+# Columns needed by the app when loading the raw data - year, country and every diagnosis/summary column in the category maps
+def get_columns_projection(categories=list(diagnoses_categories_map.keys())):
+    return ["year", entity_column] + get_columns_from_categories(categories, include_category_summary=True)
+
+# Explicit dtypes for the projected columns so pandas does not need to infer them
+def get_columns_dtypes(columns):
+    dtypes = {column: "float64" for column in columns}
+    dtypes.update({"year": "int64", entity_column: str})
+    return dtypes
+
+# Parses csv data from a file path or buffer, only reading the projected columns
+def read_csv_projected(filepath_or_buffer, columns):
+    return pd.read_csv(filepath_or_buffer,
+                       usecols=columns,
+                       dtype=get_columns_dtypes(columns),
+                       encoding=data_encoding)
+
+# Fetch csv data from url and avoids additional http requests if cached data exists from previous call to function.
+# The csv is parsed from the response stream, and kept in a persistent cache that is revalidated with the server (see app_fetch.py)
+async def get_web_data_async(url, columns=None):
     global data_df_cached
 
-    if data_df_cached is None:
-        try:
-            response = await pyodide.http.pyfetch(url)
-            if response.ok:
-                data = await response.string()
-                data_df = pd.read_csv(StringIO(data))
-                data_df_cached = data_df.copy() # Cache data as global variable
-                return data_df
-            else:
-                raise Exception(f"Fetch Error with STATUS {response.status}. {response.status_text}")
-        except:
-            raise
-    else:
-        return data_df_cached
+    if columns is None:
+        columns = get_columns_projection()
+
+    async with web_data_lock:
+        if data_df_cached is None:
+            count("load_data.web_fetches")
+            data_df_cached = await fetch_and_parse_async(url, lambda stream: read_csv_projected(stream, columns)) # Cache data as global variable
+
+    return data_df_cached
 
-def get_local_data(filename):
+# Loads the data assets of the exported site (see app_export.py): the snapshot of the columns of the categories, which the
+# plot needs, and the precomputed layouts, fetched together. The summary columns, only shown in the table, are a separate
+# asset fetched later (see load_table_data_async) so that the plot does not wait for them
+async def get_asset_data_async():
+    global data_df_cached, precomputed_layouts_bytes
+
+    async with web_data_lock:
+        if data_df_cached is None:
+            count("load_data.asset_fetches")
+            data_df, layouts_bytes = await asyncio.gather(
+                fetch_asset_and_parse_async("data", lambda stream: load_snapshot(BytesIO(stream.read()))),
+                fetch_asset_and_parse_async("layouts", lambda stream: stream.read()))
+            precomputed_layouts_bytes = layouts_bytes
+            data_df_cached = data_df # Cache data as global variable
+
+    return data_df_cached
+
+# Loads the columns only used by the table (the category summary columns) if they are not loaded yet.
+# Only the exported site loads them separately (the "aggregates" asset), they are added to the base matrix once they arrive
+async def load_table_data_async():
+    global table_data_loaded
+
+    async with table_data_lock:
+        if data_source == "assets" and not table_data_loaded:
+            count("load_data.table_asset_fetches")
+            aggregates_df = await fetch_asset_and_parse_async("aggregates", lambda stream: load_snapshot(BytesIO(stream.read())))
+            with base_matrix_lock:
+                add_base_matrix_columns(base_matrix_cached, aggregates_df)
+        table_data_loaded = True
+
+# Loads local data - prefers the binary snapshot built by app_snapshot.py and falls back to parsing the csv
+# if there is no snapshot, or it was built from another version of the csv or lacks some of the columns
+def get_local_data(filename, columns=None):
     global data_df_cached
-    if data_df_cached is None:
-        infile = Path(__file__).parent / filename
-        df = pd.read_csv(infile)
-        data_df_cached = df.copy()
-        return df
-    else:
-        return data_df_cached
+
+    if columns is None:
+        columns = get_columns_projection()
+
+    with data_lock, span("load_data"):
+        if data_df_cached is None:
+            infile = Path(__file__).parent / filename
+            snapshot_file = get_snapshot_path(infile)
+            if snapshot_file.exists() and is_snapshot_current(snapshot_file, infile, columns):
+                df = load_snapshot(snapshot_file)[columns]
+            else:
+                if snapshot_file.exists():
+                    count("load_data.stale_snapshots")
+                df = read_csv_projected(infile, columns)
+            data_df_cached = df # Cache data as global variable
+
+    return data_df_cached
     
-# Impute missing values with median of the entire column metric
+# Imports the modelling modules ahead of the first fit - run in the background once the UI has been served (see app_server.py)
+def preload_model_modules():
+    with span("import.model_modules"):
+        for module in model_modules:
+            importlib.import_module(module)
+
+# Impute missing values with median of the entire column metric.
+# Returns the countries, the column names kept (columns with no data at all are dropped) and the imputed NumPy array
 def impute_median(df):
-    from sklearn.impute import SimpleImputer
-    
-    imputer = SimpleImputer(strategy = "median")                 
+    countries = df[[entity_column]].reset_index(drop=True)
+    columns = list(df.columns[1:]) # Without country column
+    values = df[columns].to_numpy(dtype=float)
 
     # Impute the remain small numbers (~25) of missing values using median of each column
-    df_imputed = pd.DataFrame(imputer.fit_transform(df.iloc[:,1:]), # Without country column
-                              columns = df.columns[1:])
-    
-    countries = df[['country']].reset_index(drop=True)
-    
-    df_imputed = pd.concat([countries,df_imputed], axis=1)
-    
-    X_train=df_imputed.drop('country',axis=1)
-    
-    return countries, X_train
+    if model_backend == "sklearn":
+        imputer = importlib.import_module("sklearn.impute").SimpleImputer(strategy = "median")
+        values = imputer.fit_transform(values)
+        kept_columns = np.flatnonzero(~np.isnan(imputer.statistics_))
+    else:
+        values, kept_columns = impute_median_array(values)
+
+    return countries, [columns[index] for index in kept_columns], values
+
+# Zero mean and unit variance scaling of each column
+def scale_columns(values):
+    if model_backend == "sklearn":
+        return importlib.import_module("sklearn.preprocessing").StandardScaler().fit_transform(values)
+
+    return standard_scale(values)
 
 # Get selected column names using diagnoses_categories_map_aggregates from app_variables.py
 def get_columns_from_categories(categories, include_category_summary):
@@ -75,61 +180,383 @@ def get_columns_from_categories(categories, include_category_summary):
         
     return columns_selected
 
-# Performs data processing steps to create a dataframe for training model
-def data_processing(df, categories=list(diagnoses_categories_map.keys()), scaling = True, 
-                    include_category_summary=False):
-    
-    df_temp = df.copy()
+# Fills missing values for each entity with the latest (by year) value using .ffil().
+# Same result as updating a copy of df with the filled values, without the slow DataFrame.update
+def forward_fill(df):
+    return pd.concat([df[[entity_column]], df.groupby(entity_column, sort=False).ffill()], axis=1)[df.columns]
 
-    # Get selected columns using category to columns map
-    columns_selected = get_columns_from_categories(categories, include_category_summary)
-    
-    # Fills missing values in-place for each country with the latest (by year) value using .ffil()
-    df_temp.update(df.groupby("country").ffill())
+# Squared distances between countries summed over the (scaled) columns of each category, for each category.
+# Also takes a batch of matrices (e.g. years x countries x columns)
+def get_category_distances(scaled, column_index):
+    category_distances = {}
+    for category in diagnoses_categories_map:
+        column_indexes = [column_index[column] for column in diagnoses_categories_map[category] if column in column_index]
+        category_distances[category] = make_read_only(squared_distances(scaled[..., column_indexes]))
+    return category_distances
+
+# Builds the base matrix (countries x all diagnosis columns) from the raw data.
+# Does not depend on the selected categories, so only needs to run once per dataset.
+def build_base_matrix(df):
+    countries, columns, values, scaled = process_latest_values(df)
+    column_index = {column: index for index, column in enumerate(columns)}
+
+    # Squared distances between countries summed over the (scaled) columns of each category.
+    # Squared euclidean distances add up over columns, so the distances for a selection of categories are the sum of
+    # their matrices - the cost of a refit does not depend on the number of columns selected (see get_subset_distances).
+    # Not built for large datasets (memory grows with the square of the number of entities), which use fit_layout_approximate
+    category_distances = None
+    if len(countries) <= exact_layout_max_points:
+        with span("base_matrix.distances"):
+            category_distances = get_category_distances(scaled, column_index)
 
-    # Takes the latest value by using the year 2021, and filters for only the diagnoses columns
-    latest_diagnoses = df_temp[df_temp['year']==2021][["country"]+columns_selected]
+    return make_base_matrix(df, countries, columns, values, scaled, category_distances)
+
+# Latest values of every diagnosis and summary column of the raw data - forward filled, without the dropped entities,
+# imputed and scaled. Returns the countries, the column names kept, the values and the scaled values
+def process_latest_values(df):
+    # Every diagnosis and summary column present in the raw data
+    diagnosis_columns = [column for column in df.columns if column not in ("year", entity_column)]
+
+    with span("base_matrix.ffill"):
+        df_temp = forward_fill(df)
+
+    # Takes the latest value by using the year data_year (2021), and filters for only the diagnoses columns
+    latest_diagnoses = df_temp[df_temp['year']==data_year][[entity_column]+diagnosis_columns]
     
-    # Drop countries with many metrics missing - list derived from Pandas exploration not shown here
-    to_drop_countries = ["United Kingdom","China (People's Republic of)","Estonia","India",
-                         "Indonesia","Russia","South Africa","Brazil","Colombia"]
-    latest_diagnoses_dropped = latest_diagnoses[-latest_diagnoses['country'].isin(to_drop_countries)]
+    # Drop entities with many metrics missing (to_drop_entities in app_variables.py)
+    latest_diagnoses_dropped = latest_diagnoses[-latest_diagnoses[entity_column].isin(to_drop_entities)]
+
+    # Impute median for remaining missing values - median of each column is independent of the other columns
+    with span("base_matrix.impute"):
+        countries, columns, values = impute_median(latest_diagnoses_dropped)
+
+    # Scaling is also per column, so a column slice of the scaled matrix equals scaling the slice
+    with span("base_matrix.scale"):
+        scaled = scale_columns(values)
+
+    return countries, columns, values, scaled
+
+def make_base_matrix(df, countries, columns, values, scaled, category_distances):
+    return {
+        "source": df, # Raw data the matrix was built from - used to check the cache
+        "countries": countries,
+        "columns": columns,
+        "column_index": {column: index for index, column in enumerate(columns)},
+        "values": make_read_only(values),
+        "scaled": make_read_only(scaled),
+        "category_distances": category_distances,
+        "layouts": LRUCache(maxsize=layout_cache_size), # Memoized fit_layout results, see get_layout
+        "year_matrices": None, # All years, built on first use (see get_year_matrices)
+        "year_layouts": LRUCache(maxsize=layout_cache_size), # Memoized layouts of all years, see get_year_layouts
+        "disk_cache_key": None, # Key of the data in the disk cache (app_disk_cache.py), None if the disk cache is disabled
+    }
+
+# Adds the columns of other raw data of the same rows (e.g. the summary columns loaded later by the exported site) to the
+# base matrix. Imputation and scaling are per column, so the values are the same as if the base matrix had been built with
+# these columns. They are appended, so the column numbers already in use stay valid
+def add_base_matrix_columns(base, df):
+    countries, columns, values, scaled = process_latest_values(df)
+    if not countries[entity_column].equals(base["countries"][entity_column]):
+        raise ValueError("The added columns are not for the same entities as the base matrix")
+
+    base["values"] = make_read_only(np.hstack([base["values"], values]))
+    base["scaled"] = make_read_only(np.hstack([base["scaled"], scaled]))
+    base["column_index"] = {**base["column_index"], **{column: len(base["columns"]) + index for index, column in enumerate(columns)}}
+    base["columns"] = base["columns"] + columns
+
+# Stores the base matrix in the disk cache. The category distances are stacked in the order of diagnoses_categories_map
+def save_base_matrix(base, key):
+    arrays = {
+        "countries": np.array(base["countries"][entity_column], dtype=str),
+        "columns": np.array(base["columns"], dtype=str),
+        "values": base["values"],
+        "scaled": base["scaled"],
+    }
+    if base["category_distances"] is not None:
+        arrays["category_distances"] = np.stack([base["category_distances"][category] for category in diagnoses_categories_map])
+    save_entry(get_entry_path(key, "base"), arrays)
+
+# Base matrix of the raw data from the disk cache (memory-mapped), or None if it is not cached
+def load_base_matrix(df, key):
+    arrays = load_entry(get_entry_path(key, "base"))
+    if arrays is None:
+        return None
+
+    category_distances = None
+    if "category_distances" in arrays:
+        category_distances = dict(zip(diagnoses_categories_map, arrays["category_distances"]))
+
+    return make_base_matrix(df, pd.DataFrame({entity_column: arrays["countries"].tolist()}), arrays["columns"].tolist(),
+                            arrays["values"], arrays["scaled"], category_distances)
+
+# Returns the cached base matrix, only rebuilding it when called with a different raw dataframe.
+# A base matrix built by an earlier process for the same data is loaded from the disk cache
+def get_base_matrix(df):
+    global base_matrix_cached
 
-    # Impute median for remaining missing values and create training dataframe
-    countries, X_train = impute_median(latest_diagnoses_dropped)
+    with base_matrix_lock:
+        if base_matrix_cached is None or base_matrix_cached["source"] is not df:
+            with span("base_matrix"):
+                key = get_cache_key(df)
+                base_matrix = None
+                if key is not None:
+                    touch_cache_key(key)
+                    base_matrix = load_base_matrix(df, key)
+                if base_matrix is None:
+                    base_matrix = build_base_matrix(df)
+                    if key is not None:
+                        save_base_matrix(base_matrix, key)
+                base_matrix["disk_cache_key"] = key
+
+            # Layouts precomputed by app_layouts.py - None if there is no layouts file for this data
+            with span("load_layouts"):
+                layouts_file = (BytesIO(precomputed_layouts_bytes) if precomputed_layouts_bytes is not None
+                                else get_layouts_path(Path(__file__).parent / data_filename))
+                base_matrix["precomputed_layouts"] = load_layouts(layouts_file, base_matrix)
+
+            base_matrix_cached = base_matrix
+
+        return base_matrix_cached
+
+# Multi-year mode - the matrices of every year from data_first_year to data_year built together as one
+# years x countries x columns array. Same countries and columns as the base matrix (the ones of the raw data, without
+# columns added later by add_base_matrix_columns), so a point is the same country in every year.
+# Missing values are forward filled, then imputed with the median of the year and each year is scaled on its own
+def build_year_matrices(df, base):
+    countries = base["countries"][entity_column]
+    columns = [column for column in base["columns"] if column in df.columns]
+    column_index = {column: index for index, column in enumerate(columns)}
+    df_filled = forward_fill(df)
+    years = np.array(sorted(year for year in df_filled["year"].unique() if data_first_year <= year <= data_year))
+
+    # Rows of every (year, country) pair, in year then base matrix country order - missing rows are all missing values
+    rows = pd.MultiIndex.from_product([years, countries])
+    values = df_filled.set_index(["year", entity_column]).reindex(rows)[columns]\
+        .to_numpy(dtype=float).reshape(len(years), len(countries), len(columns))
+
+    scaled = standard_scale(impute_median_batch(values))
+
+    return {
+        "years": years,
+        "year_index": {int(year): index for index, year in enumerate(years)},
+        "columns": columns,
+        "column_index": column_index,
+        "scaled": make_read_only(scaled),
+        # years x countries x countries for each category, see build_base_matrix
+        "category_distances": get_category_distances(scaled, column_index) if base["category_distances"] is not None else None,
+    }
+
+# Returns the year matrices of the cached base matrix, building them on first use
+def get_year_matrices(df):
+    base = get_base_matrix(df)
+
+    with year_matrices_lock:
+        if base["year_matrices"] is None:
+            with span("year_matrices"):
+                base["year_matrices"] = load_year_matrices(base)
+                if base["year_matrices"] is None:
+                    base["year_matrices"] = build_year_matrices(df, base)
+                    save_year_matrices(base)
+
+        return base["year_matrices"]
+
+# Stores the year matrices of the base matrix in the disk cache (category distances stacked as in save_base_matrix)
+def save_year_matrices(base):
+    if base["disk_cache_key"] is None:
+        return
+
+    year_matrices = base["year_matrices"]
+    arrays = {"years": year_matrices["years"], "columns": np.array(year_matrices["columns"], dtype=str), "scaled": year_matrices["scaled"]}
+    if year_matrices["category_distances"] is not None:
+        arrays["category_distances"] = np.stack([year_matrices["category_distances"][category] for category in diagnoses_categories_map])
+    save_entry(get_entry_path(base["disk_cache_key"], "year_matrices"), arrays)
+
+# Year matrices of the base matrix from the disk cache, or None if they are not cached
+def load_year_matrices(base):
+    if base["disk_cache_key"] is None:
+        return None
+
+    arrays = load_entry(get_entry_path(base["disk_cache_key"], "year_matrices"))
+    if arrays is None:
+        return None
+
+    return {
+        "years": arrays["years"],
+        "year_index": {int(year): index for index, year in enumerate(arrays["years"])},
+        "columns": arrays["columns"].tolist(),
+        "column_index": {column: index for index, column in enumerate(arrays["columns"].tolist())},
+        "scaled": arrays["scaled"],
+        "category_distances": dict(zip(diagnoses_categories_map, arrays["category_distances"])) if "category_distances" in arrays else None,
+    }
+
+# Column slice of the base matrix for the selected categories. Returns countries, column names and NumPy array
+def get_training_matrix(df, categories=list(diagnoses_categories_map.keys()), scaling = True, 
+                        include_category_summary=False):
+    base = get_base_matrix(df)
+
+    # Get selected columns using category to columns map (columns with no data at all were dropped by the imputer)
+    columns_selected = [column 
+                        for column in get_columns_from_categories(categories, include_category_summary)
+                        if column in base["column_index"]]
+    column_indexes = [base["column_index"][column] for column in columns_selected]
 
     # Normalisation and scaling only required for Machine learning
-    if scaling:
-        from sklearn.preprocessing import StandardScaler
-        scaler = StandardScaler()
-        X_train = pd.DataFrame(scaler.fit_transform(X_train), columns = X_train.columns)
+    matrix = base["scaled"] if scaling else base["values"]
+
+    return base["countries"], columns_selected, matrix[:, column_indexes]
+
+# Squared distances between countries over the scaled columns of the selected categories (countries x countries)
+def get_subset_distances(df, categories):
+    category_distances = get_base_matrix(df)["category_distances"]
+    return sum(category_distances[category] for category in set(categories))
+
+# Fits the embedding and the labels for every number of clusters for the selected categories (not cached).
+# Large datasets (more than exact_layout_max_points entities) use the scalable approximate methods
+def fit_category_layout(df, categories):
+    count("layout.refits")
+    base = get_base_matrix(df)
+
+    if base["category_distances"] is None:
+        _, _, training_data = get_training_matrix(df, categories, scaling=True)
+        X_reduced, labels_by_num_groups = fit_layout_approximate(training_data)
+    elif model_backend == "sklearn":
+        _, _, training_data = get_training_matrix(df, categories, scaling=True)
+        X_reduced, labels_by_num_groups = fit_layout(training_data)
+    else:
+        X_reduced, labels_by_num_groups = fit_layout_from_distances(get_subset_distances(df, categories))
+    return make_read_only(X_reduced), make_read_only(labels_by_num_groups)
+
+# Embedding coordinates and cluster labels for the selected categories.
+# Selections in the precomputed layouts file are looked up, others are fitted live.
+# The layout cache is shared by all sessions, so identical selections by different users are only fitted once.
+# The embedding and the labels for every number of clusters are memoized together in the base matrix layout cache,
+# so changing num_groups only picks another row of labels. The order of categories does not matter so the key uses a frozenset
+# Other years than data_year are looked up in the layouts of all years (see get_year_layouts)
+def get_layout(df, categories, num_groups, year=data_year):
+    if year != data_year:
+        year_index = get_year_matrices(df)["year_index"][year]
+        X_reduced_by_year, labels_by_year = get_year_layouts(df, categories)
+        return X_reduced_by_year[year_index], labels_by_year[year_index][num_groups-1]
+
+    X_reduced, labels_by_num_groups = get_category_layout(df, categories)
+
+    return X_reduced, labels_by_num_groups[num_groups-1]
+
+# Embedding coordinates and labels for every number of clusters for the selected categories in data_year (memoized)
+def get_category_layout(df, categories):
+    base = get_base_matrix(df)
+
+    def fit():
+        precomputed = get_precomputed_layout(base["precomputed_layouts"], categories)
+        if precomputed is not None:
+            count("layout.precomputed")
+            X_reduced, labels_by_num_groups = precomputed
+            return make_read_only(X_reduced), make_read_only(labels_by_num_groups)
 
-    return countries, X_train
+        # Layouts fitted by an earlier process for the same data are loaded from the disk cache
+        return get_or_compute(base["disk_cache_key"], ["layouts", get_category_entry(categories)], ["coordinates", "labels"],
+                              lambda: fit_category_layout(df, categories))
+
+    return base["layouts"].get_or_compute(frozenset(categories), fit)
+
+# Embedding coordinates (years x countries x 2) and labels (years x number of clusters x countries) of every year for the
+# selected categories. All years are fitted in one batch on the first request, so changing the year only picks a slice.
+# The layouts are aligned from year to year starting from the data_year layout (the one shown by default),
+# so that countries move and change color as little as possible when stepping through the years
+def get_year_layouts(df, categories):
+    base = get_base_matrix(df)
+
+    def fit_all_years():
+        count("layout.year_refits")
+        year_matrices = get_year_matrices(df)
+
+        with span("year_layouts"):
+            if year_matrices["category_distances"] is None:
+                column_indexes = [year_matrices["column_index"][column]
+                                  for column in get_columns_from_categories(categories, include_category_summary=False)
+                                  if column in year_matrices["column_index"]]
+                layouts = [fit_layout_approximate(scaled[:, column_indexes]) for scaled in year_matrices["scaled"]]
+                X_reduced, labels_by_num_groups = np.array([layout[0] for layout in layouts]), np.array([layout[1] for layout in layouts])
+            else:
+                distances = sum(year_matrices["category_distances"][category] for category in set(categories))
+                X_reduced, labels_by_num_groups = fit_layouts_from_distances(distances)
+
+            anchor = year_matrices["year_index"][data_year]
+            X_reduced[anchor], labels_by_num_groups[anchor] = get_category_layout(df, categories)
+            X_reduced, labels_by_num_groups = align_layouts(X_reduced, labels_by_num_groups, anchor)
+
+        return make_read_only(X_reduced), make_read_only(labels_by_num_groups)
+
+    def fit():
+        return get_or_compute(base["disk_cache_key"], ["year_layouts", get_category_entry(categories)], ["coordinates", "labels"],
+                              fit_all_years)
+
+    return base["year_layouts"].get_or_compute(frozenset(categories), fit)
+
+# Name of the disk cache entry of a category selection - the order of the categories does not matter
+def get_category_entry(categories):
+    return f"{get_category_mask(categories):x}"
+
+# Hit/miss counters of the layout cache, for the profiling output
+def get_cache_info():
+    if base_matrix_cached is None:
+        return {}
+    return {"layouts": base_matrix_cached["layouts"].info(), "year_layouts": base_matrix_cached["year_layouts"].info()}
+
+# Profiling timings and counters together with the cache counters - shown in the debug panel and /profiling.json
+def get_profiling_report():
+    return {**get_profile(), "caches": get_cache_info()}
+
+# Performs data processing steps to create a dataframe for training model
+def data_processing(df, categories=list(diagnoses_categories_map.keys()), scaling = True, 
+                    include_category_summary=False):
+    
+    countries, columns_selected, X_train = get_training_matrix(df, categories, scaling, include_category_summary)
+
+    return countries.copy(), pd.DataFrame(X_train, columns = columns_selected)
 
 # Loads data and performs data processing and modelling to return a data required for plotting
-async def train_and_get_plot(categories = [], num_groups = 3, on_select_callback = None):
+async def train_and_get_plot(categories = [], num_groups = 3, on_select_callback = None, year = data_year):
     url = data_url
     
     # Load data from url
     # Asynchronous because may not be successful if http request fails e.g. timeout. 
     # Returns an empty figure if fails to fetch data rather than crashing the app
     try:
-        #oecd_df = await get_web_data_async(url)
-        oecd_df = get_local_data("OCED_simplified.csv")
+        if data_source == "web":
+            oecd_df = await get_web_data_async(url)
+        elif data_source == "assets":
+            oecd_df = await get_asset_data_async()
+        else:
+            oecd_df = get_local_data(data_filename)
     except Exception as e:
         print(e)
         return plt.figure(figsize=(6, 4), title = "Error getting data from URL")
 
-    # Data Processing
-    countries, training_data = data_processing(oecd_df, categories, scaling=True)
+    # Data Processing and modelling
+    countries = get_base_matrix(oecd_df)["countries"]
+    X_reduced, labels = get_layout(oecd_df, categories, num_groups, year)
 
     # Create bqplot figure object
-    fig = create_plot(training_data, countries, num_groups, on_select = on_select_callback)
+    fig = create_plot(X_reduced, labels, countries, on_select = on_select_callback)
 
     return fig
 
-# Retrains and updates figure in-place
-def train_and_update_plot(fig, categories = [], num_groups = 3, selected_countries=[]):
+# Fits (or gets from cache) the layout for the selected categories and year without touching the figure,
+# so it is safe to run in a worker thread. Returns None if there is no data or no categories selected
+def fit_plot_layout(categories = [], num_groups = 3, year = data_year):
+    global data_df_cached
+
+    if data_df_cached is None or len(categories)==0:
+        return None
+
+    countries = get_base_matrix(data_df_cached)["countries"]
+    X_reduced, labels = get_layout(data_df_cached, categories, num_groups, year)
+
+    return countries, X_reduced, labels
+
+# Updates the figure in-place with a layout returned by fit_plot_layout
+def update_plot_layout(fig, layout, categories = [], selected_countries=[]):
     global data_df_cached # Function should only be called after successful initial plot with data, so get data from cache
 
     # If data not available, don't do anything to the figure (should be displaying error message)
@@ -137,14 +564,19 @@ def train_and_update_plot(fig, categories = [], num_groups = 3, selected_countri
         return 
 
     # If no cateogires selected - empty the plot and show feedback as the plot title
-    if len(categories)==0:
+    if len(categories)==0 or layout is None:
         empty_plot_with_title(title="Please Select At Least One Category...", fig=fig)
         return
 
-    oecd_df = data_df_cached.copy()
-
-    # Reprocess the data on selected categories
-    countries, training_data = data_processing(oecd_df, categories, scaling=True)
+    countries, X_reduced, labels = layout
 
     # Use create_plot again but pass the figure object and set param update_plot to True. This modifies the fig in-place
-    create_plot(training_data, countries, num_groups, fig, selected_countries=selected_countries, update_plot=True)
\ No newline at end of file
+    with span("plot.update"):
+        create_plot(X_reduced, labels, countries, fig, selected_countries=selected_countries, update_plot=True)
+
+# Retrains and updates figure in-place
+def train_and_update_plot(fig, categories = [], num_groups = 3, selected_countries=[], year = data_year):
+    # Refit on the selected categories, or reuse a previously fitted layout
+    layout = fit_plot_layout(categories, num_groups, year)
+
+    update_plot_layout(fig, layout, categories, selected_countries)
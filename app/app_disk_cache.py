@@ -0,0 +1,163 @@
+# Python modules
+import hashlib
+import importlib.metadata
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# From local files
+from app_variables import diagnoses_categories_map, diagnoses_categories_map_aggregates, entity_column, data_year, data_first_year
+from app_variables import to_drop_entities, exact_layout_max_points, model_backend, disk_cache_enabled, disk_cache_dir, disk_cache_max_datasets
+from app_instrumentation import count
+
+# Persistent cache of the processed matrices and fitted layouts, so a restarted server process does not repeat
+# the forward fill, imputation, scaling and distances, or any layout fit a user already triggered.
+# Each dataset has a directory named by its cache key (see get_cache_key) holding one entry directory per result:
+#   <key>/base/                    - base matrix (see build_base_matrix in app_data_processing.py)
+#   <key>/year_matrices/           - matrices of every year (see build_year_matrices)
+#   <key>/layouts/<mask>/          - embedding and labels of a category selection (mask from app_layouts.get_category_mask)
+#   <key>/year_layouts/<mask>/     - embedding and labels of every year of a category selection
+# An entry is a directory of .npy files, loaded memory-mapped so that the arrays are only read from disk when used and
+# the pages are shared by every process of the server. Entries are written to a temporary directory and renamed into place,
+# so other processes (or a crash part way) never leave a partly written entry.
+# Nothing is ever invalidated in place: other data, settings, model code or library versions give another key,
+# and the directories of the least recently used keys are deleted beyond disk_cache_max_datasets
+
+logger = logging.getLogger("app.disk_cache")
+
+# Increase when the layout of the entries changes
+cache_format = 1
+
+# Modules whose code determines the processed matrices and the layouts
+model_code_files = ["app_data_processing.py", "app_numeric.py", "app_plotting.py"]
+
+# Versions of the libraries the results depend on (scikit-learn and SciPy only with the scikit-learn backend,
+# read from the package metadata so that they are not imported before they are needed)
+def get_library_versions():
+    versions = {"python": sys.version.split()[0], "numpy": np.__version__, "pandas": pd.__version__}
+    for library in ["scikit-learn", "scipy"] if model_backend == "sklearn" else []:
+        try:
+            versions[library] = importlib.metadata.version(library)
+        except importlib.metadata.PackageNotFoundError:
+            versions[library] = None
+    return versions
+
+# Settings of app_variables.py used by the processing and the model
+def get_processing_settings():
+    return {
+        "entity_column": entity_column,
+        "data_year": data_year,
+        "data_first_year": data_first_year,
+        "to_drop_entities": to_drop_entities,
+        "exact_layout_max_points": exact_layout_max_points,
+        "model_backend": model_backend,
+        "categories": diagnoses_categories_map,
+        "aggregates": diagnoses_categories_map_aggregates,
+    }
+
+# Hash of the source of the model code files
+def get_code_hash():
+    digest = hashlib.sha1()
+    for filename in model_code_files:
+        digest.update((Path(__file__).parent / filename).read_bytes())
+    return digest.hexdigest()
+
+# Adds the column names, dtypes and values of a dataframe to a hash. The numeric columns are hashed as one matrix
+def update_hash_with_dataframe(digest, df):
+    digest.update(json.dumps([[str(column), str(dtype)] for column, dtype in df.dtypes.items()]).encode())
+
+    numeric_columns = [column for column, dtype in df.dtypes.items() if dtype.kind in "biuf"]
+    digest.update(np.ascontiguousarray(df[numeric_columns].to_numpy(dtype=np.float64)).tobytes())
+    for column in df.columns.difference(numeric_columns, sort=False):
+        digest.update("\0".join(map(str, df[column])).encode())
+
+# Cache key of the raw data (as loaded, whether from the csv, the snapshot or data_url) - None if the cache is disabled
+def get_cache_key(df):
+    if not disk_cache_enabled:
+        return None
+
+    digest = hashlib.sha1()
+    digest.update(json.dumps({
+        "format": cache_format,
+        "settings": get_processing_settings(),
+        "versions": get_library_versions(),
+        "code": get_code_hash(),
+    }, sort_keys=True).encode())
+    update_hash_with_dataframe(digest, df)
+    return digest.hexdigest()
+
+# Path of an entry of a cache key
+def get_entry_path(key, *names):
+    return Path(disk_cache_dir, key, *names)
+
+# Arrays of an entry (memory-mapped and read-only) by file name, or None if there is no such entry
+def load_entry(path):
+    path = Path(path)
+    if not path.is_dir():
+        count("disk_cache.misses")
+        return None
+
+    try:
+        arrays = {file.stem: np.load(file, mmap_mode="r", allow_pickle=False).view(np.ndarray) for file in path.glob("*.npy")}
+    except (OSError, ValueError) as error:
+        logger.warning("Could not read %s: %s", path, error)
+        count("disk_cache.misses")
+        return None
+
+    count("disk_cache.hits")
+    return arrays
+
+# Stores arrays (name -> array) as a new entry. Does nothing if another process stored the same entry first
+def save_entry(path, arrays):
+    path = Path(path)
+    temporary_path = path.with_name(f"{path.name}.part-{os.getpid()}-{threading.get_ident()}")
+
+    try:
+        temporary_path.mkdir(parents=True)
+        for name, array in arrays.items():
+            np.save(temporary_path / f"{name}.npy", np.asarray(array), allow_pickle=False)
+        os.rename(temporary_path, path)
+    except OSError as error:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        if not path.is_dir():
+            logger.warning("Could not write %s: %s", path, error)
+
+# Returns the arrays (in the order of names) of an entry of the cache key, computing them with compute_function()
+# and storing them on a miss. compute_function() returns the arrays in the order of names.
+# Returns compute_function() directly if key is None (cache disabled)
+def get_or_compute(key, entry, names, compute_function):
+    if key is None:
+        return compute_function()
+
+    path = get_entry_path(key, *entry)
+    arrays = load_entry(path)
+    if arrays is not None and all(name in arrays for name in names):
+        return tuple(arrays[name] for name in names)
+
+    values = compute_function()
+    save_entry(path, dict(zip(names, values)))
+    return values
+
+# Marks a cache key as used and deletes the directories of the least recently used keys beyond disk_cache_max_datasets
+def touch_cache_key(key):
+    key_path = get_entry_path(key)
+    try:
+        key_path.mkdir(parents=True, exist_ok=True)
+        os.utime(key_path)
+
+        key_paths = sorted((path for path in Path(disk_cache_dir).iterdir() if path.is_dir() and len(path.name) == len(key)),
+                           key=lambda path: path.stat().st_mtime, reverse=True)
+    except OSError as error:
+        logger.warning("Could not use the cache directory %s: %s", disk_cache_dir, error)
+        return
+
+    for path in key_paths[disk_cache_max_datasets:]:
+        if path != key_path:
+            count("disk_cache.pruned")
+            shutil.rmtree(path, ignore_errors=True)
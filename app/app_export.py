@@ -0,0 +1,99 @@
+# Python modules
+import base64
+import hashlib
+import io
+import json
+import zipfile
+from pathlib import Path
+import numpy as np
+
+# From local files
+from app_snapshot import get_snapshot_arrays, get_snapshot_columns
+from app_layouts import get_layouts_path
+from app_variables import diagnoses_categories_map, data_filename, data_manifest_filename
+
+# Build step - exports the app for Shinylive as a small code bundle and separately fetched data assets, instead of one
+# app.json with the csv inlined (which the browser has to download and parse before any Python runs):
+#   <site>/app.json  - the code files of the app as read by Shinylive (see docs/index.html): a list of
+#                      {"name", "content", "type"} entries ("binary" content is base64 encoded), and data_manifest.json
+#                      which lists the data assets (app_variables.py switches to data_source "assets" when it is there)
+#   <site>/data/     - the data assets, compressed .npz files named by a hash of their content, so browsers and the
+#                      fetch cache (app_fetch.py) keep them without ever revalidating them:
+#       data       - snapshot (see app_snapshot.py) of the columns of the categories, all the plot needs
+#       layouts    - precomputed layouts (see app_layouts.py), fetched together with data
+#       aggregates - snapshot of the category summary columns, only shown in the table and fetched once the plot is shown
+# Only app.json and data/ are written - the Shinylive runtime (shinylive/, index.html, ...) comes from `shinylive export`
+
+# Files of the app directory left out of the code bundle: build steps that do not run in the browser, data files
+# (replaced by the data assets) and caches
+excluded_files = ["app_export.py", "app_batch.py", data_manifest_filename]
+excluded_suffixes = [".csv", ".npz", ".pyc"]
+
+# Snapshot columns of each snapshot asset - the columns of the categories, then the remaining (summary) columns
+def get_asset_columns():
+    category_columns = list(dict.fromkeys(column for columns in diagnoses_categories_map.values() for column in columns))
+    return {
+        "data": category_columns,
+        "aggregates": [column for column in get_snapshot_columns() if column not in category_columns],
+    }
+
+# Compressed .npz of the arrays. Unlike np.savez_compressed the entries have a fixed date, so the same arrays always give
+# the same bytes (and the same content hash)
+def get_npz_bytes(arrays):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, array in arrays.items():
+            entry = zipfile.ZipInfo(f"{name}.npy", date_time=(1980, 1, 1, 0, 0, 0))
+            entry.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(entry, "w") as file:
+                np.lib.format.write_array(file, np.asanyarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+# Code bundle entry of a file of the app directory
+def get_bundle_entry(path):
+    content = path.read_bytes()
+    try:
+        return {"name": path.name, "content": content.decode("utf-8"), "type": "text"}
+    except UnicodeDecodeError:
+        return {"name": path.name, "content": base64.b64encode(content).decode("ascii"), "type": "binary"}
+
+# Writes the data assets and app.json to site_dir. Assets of earlier exports that are no longer used are deleted
+def export_site(site_dir, app_dir=Path(__file__).parent):
+    site_dir, app_dir = Path(site_dir), Path(app_dir)
+    csv_path = app_dir / data_filename
+    data_dir = site_dir / "data"
+    data_dir.mkdir(parents=True, exist_ok=True)
+
+    assets = {name: get_npz_bytes(get_snapshot_arrays(csv_path, columns)) for name, columns in get_asset_columns().items()}
+    assets["layouts"] = get_layouts_path(csv_path).read_bytes()
+
+    manifest = {"assets": {}}
+    for name, content in assets.items():
+        file_name = f"{csv_path.stem}.{name}.{hashlib.sha256(content).hexdigest()[:16]}.npz"
+        (data_dir / file_name).write_bytes(content)
+        manifest["assets"][name] = {"file": f"data/{file_name}", "size": len(content)}
+
+    used_files = {Path(asset["file"]).name for asset in manifest["assets"].values()}
+    for path in data_dir.glob(f"{csv_path.stem}.*.npz"):
+        if path.name not in used_files:
+            path.unlink()
+
+    # app.py first, as in the bundles written by shinylive
+    code_files = sorted((path for path in app_dir.iterdir()
+                         if path.is_file() and path.name not in excluded_files and path.suffix not in excluded_suffixes),
+                        key=lambda path: (path.name != "app.py", path.name))
+    bundle = [get_bundle_entry(path) for path in code_files]
+    bundle.append({"name": data_manifest_filename, "content": json.dumps(manifest, indent=2), "type": "text"})
+    (site_dir / "app.json").write_text(json.dumps(bundle))
+
+    return manifest
+
+# Usage: python app_export.py [site_dir]
+if __name__ == "__main__":
+    import sys
+
+    site_dir = Path(sys.argv[1] if len(sys.argv) > 1 else Path(__file__).parent.parent / "docs")
+    manifest = export_site(site_dir)
+    print(f"Code bundle written to {site_dir / 'app.json'} ({(site_dir / 'app.json').stat().st_size / 1024:.0f} KB)")
+    for name, asset in manifest["assets"].items():
+        print(f"{name}: {asset['file']} ({asset['size'] / 1024:.0f} KB)")
@@ -0,0 +1,378 @@
+# Python modules
+import asyncio
+import hashlib
+import http.client
+import io
+import json
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+import zlib
+from pathlib import Path
+from urllib.parse import urljoin
+
+# From local files
+from app_variables import running_in_pyodide, data_cache_dir, data_cache_max_age, fetch_timeout, fetch_retries
+from app_variables import data_manifest_filename, data_assets_url
+from app_instrumentation import span, count
+
+# Fetch layer for remote data files (see get_web_data_async in app_data_processing.py):
+#   - a persistent cache of the response body and its validators (ETag, Last-Modified) in data_cache_dir.
+#     In the browser (Pyodide) the directory is stored in IndexedDB, so it survives page reloads
+#   - a cached copy younger than data_cache_max_age seconds is used without any request, older copies are
+#     revalidated with a conditional request (304 Not Modified reuses the cached copy)
+#   - gzip transfer encoding, decompressed while reading
+#   - timeouts and retries with exponential backoff. A download interrupted part way is resumed with a Range request
+#     when the server supports it. If every attempt fails, a stale cached copy is used if there is one
+#   - the body is parsed while it is read (parse receives a binary file-like object) and written to the cache at the
+#     same time, so the whole file is never held in memory as one string
+# The URL can point at any HTTP server, e.g. benchmarks/serve_data.py which stands in for the data host
+
+logger = logging.getLogger("app.fetch")
+
+# Seconds to wait before the first retry - doubled for every further retry
+retry_backoff = 0.5
+
+# Bytes read from the connection at a time
+chunk_size = 64 * 1024
+
+# Errors worth retrying: connection failures, timeouts, truncated bodies and server side (5xx) errors
+class RetryableFetchError(Exception):
+    pass
+
+# Paths of the cached body and metadata of a URL
+def get_cache_paths(url, cache_dir=data_cache_dir):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return Path(cache_dir) / f"{key}.body", Path(cache_dir) / f"{key}.json"
+
+# Metadata of the cached copy of a URL (validators and time fetched), or None if there is no complete cached copy
+def read_cache_metadata(url, cache_dir=data_cache_dir):
+    body_path, metadata_path = get_cache_paths(url, cache_dir)
+    try:
+        metadata = json.loads(metadata_path.read_text())
+    except (OSError, ValueError):
+        return None
+
+    if metadata.get("url") != url or not body_path.exists() or body_path.stat().st_size != metadata.get("size"):
+        return None
+    return metadata
+
+def write_cache_metadata(url, metadata, cache_dir=data_cache_dir):
+    _, metadata_path = get_cache_paths(url, cache_dir)
+    temporary_path = metadata_path.with_suffix(".json.part")
+    temporary_path.write_text(json.dumps(metadata))
+    os.replace(temporary_path, metadata_path)
+
+# Request headers - conditional on the validators of the cached copy, if any
+def get_request_headers(metadata=None):
+    headers = {"Accept-Encoding": "gzip"}
+    if metadata and metadata.get("etag"):
+        headers["If-None-Match"] = metadata["etag"]
+    if metadata and metadata.get("last_modified"):
+        headers["If-Modified-Since"] = metadata["last_modified"]
+    return headers
+
+# Writes a response body to a temporary file next to the cached copy, which replaces the cached copy on commit.
+# An interrupted download never overwrites a complete cached copy
+class CacheWriter:
+    def __init__(self, url, response_headers, cache_dir=data_cache_dir):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.body_path, _ = get_cache_paths(url, cache_dir)
+        self.temporary_path = self.body_path.with_suffix(".body.part")
+        self.metadata = {
+            "url": url,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+        }
+        self.size = 0
+
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self.file = open(self.temporary_path, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.temporary_path, self.body_path)
+        write_cache_metadata(self.url, {**self.metadata, "size": self.size, "fetched_at": time.time()}, self.cache_dir)
+
+    def discard(self):
+        self.file.close()
+        self.temporary_path.unlink(missing_ok=True)
+
+# Binary file-like object over an iterator of byte chunks, for parsers that read from a file (e.g. pandas.read_csv).
+# Every chunk read is also passed to tee (e.g. CacheWriter.write)
+class ChunkStream(io.RawIOBase):
+    def __init__(self, chunks, tee=None):
+        self.chunks = iter(chunks)
+        self.tee = tee
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, output):
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            if self.tee is not None:
+                self.tee(chunk)
+            self.buffer = chunk
+
+        size = min(len(output), len(self.buffer))
+        output[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+# Decompresses the chunks of a gzip encoded body as they arrive
+def decode_chunks(chunks, content_encoding):
+    if content_encoding != "gzip":
+        yield from chunks
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+# Server - blocking request with urllib. Returns the response, which is None for 304 Not Modified
+def open_url(url, headers, timeout=fetch_timeout):
+    try:
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            return None
+        if error.code >= 500:
+            raise RetryableFetchError(f"HTTP {error.code} {error.reason}") from error
+        raise
+    except (urllib.error.URLError, OSError) as error:
+        raise RetryableFetchError(str(error)) from error
+
+# Server - chunks of the (encoded) response body. If the connection breaks part way and the server accepts ranges,
+# the rest of the body is requested from where it stopped (If-Range makes sure it is still the same file)
+def read_body_chunks(url, response, headers, timeout=fetch_timeout):
+    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    resumable = response.headers.get("Accept-Ranges") == "bytes" and validator is not None
+    length = response.headers.get("Content-Length")
+    expected = int(length) if length is not None else None
+    received = 0
+    resumes = 0
+
+    while True:
+        try:
+            chunk = response.read(chunk_size)
+            # A connection closed early ends the body without an error - compare with the announced length
+            if not chunk and expected is not None and received < expected:
+                raise http.client.IncompleteRead(b"", expected - received)
+        except (http.client.IncompleteRead, OSError) as error:
+            response.close()
+            if not resumable or resumes >= fetch_retries:
+                raise RetryableFetchError(f"Download interrupted after {received} bytes: {error}") from error
+
+            resumes += 1
+            count("fetch.resumes")
+            resume_headers = {"Accept-Encoding": headers["Accept-Encoding"], "Range": f"bytes={received}-", "If-Range": validator}
+            response = open_url(url, resume_headers, timeout)
+            if response is None or response.status != 206:
+                raise RetryableFetchError("Download could not be resumed")
+            length = response.headers.get("Content-Length")
+            expected = received + int(length) if length is not None else None
+            continue
+
+        if not chunk:
+            response.close()
+            return
+        received += len(chunk)
+        yield chunk
+
+# Whether the cached copy is young enough to be used without asking the server (max_age None uses data_cache_max_age)
+def is_cache_fresh(metadata, max_age=None):
+    return metadata is not None and time.time() - metadata["fetched_at"] < (data_cache_max_age if max_age is None else max_age)
+
+# Server - fetches the URL (or revalidates the cached copy) and returns parse(stream) of the body
+def fetch_and_parse(url, parse, cache_dir=data_cache_dir, max_age=None):
+    metadata = read_cache_metadata(url, cache_dir)
+    body_path, _ = get_cache_paths(url, cache_dir)
+
+    if is_cache_fresh(metadata, max_age):
+        count("fetch.cache_fresh")
+        with open(body_path, "rb") as stream:
+            return parse(stream)
+
+    headers = get_request_headers(metadata)
+
+    for attempt in range(fetch_retries + 1):
+        if attempt > 0:
+            count("fetch.retries")
+            time.sleep(retry_backoff * 2 ** (attempt - 1))
+
+        writer = None
+        try:
+            count("fetch.requests")
+            response = open_url(url, headers)
+
+            if response is None:
+                count("fetch.not_modified")
+                write_cache_metadata(url, {**metadata, "fetched_at": time.time()}, cache_dir)
+                with open(body_path, "rb") as stream:
+                    return parse(stream)
+
+            writer = CacheWriter(url, response.headers, cache_dir)
+            chunks = decode_chunks(read_body_chunks(url, response, headers), response.headers.get("Content-Encoding"))
+            result = parse(io.BufferedReader(ChunkStream(chunks, tee=writer.write), buffer_size=chunk_size))
+
+            # The parser may stop before the end of the body (e.g. a truncated last line) - the cached copy must be complete
+            for chunk in chunks:
+                writer.write(chunk)
+            writer.commit()
+            return result
+        except RetryableFetchError as error:
+            if writer is not None:
+                writer.discard()
+            logger.warning("Fetching %s failed (attempt %d of %d): %s", url, attempt + 1, fetch_retries + 1, error)
+        except BaseException:
+            if writer is not None:
+                writer.discard()
+            raise
+
+    with open(get_stale_copy_path(url, metadata, cache_dir), "rb") as stream:
+        return parse(stream)
+
+# Last resort when every attempt failed - the cached copy even though it could not be revalidated
+def get_stale_copy_path(url, metadata, cache_dir=data_cache_dir):
+    if metadata is None:
+        raise ConnectionError(f"Could not fetch {url} after {fetch_retries + 1} attempts and there is no cached copy")
+
+    count("fetch.stale")
+    logger.warning("Using the cached copy of %s fetched at %s", url, time.ctime(metadata["fetched_at"]))
+    body_path, _ = get_cache_paths(url, cache_dir)
+    return body_path
+
+# Browser - data_cache_dir is mounted on IndexedDB (Emscripten IDBFS) on first use. Files are written to memory
+# and saved to IndexedDB by sync_browser_cache after each download
+browser_cache_mounted = False
+
+async def mount_browser_cache(cache_dir=data_cache_dir):
+    global browser_cache_mounted
+    if browser_cache_mounted:
+        return
+    browser_cache_mounted = True
+
+    try:
+        import pyodide_js
+
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        pyodide_js.FS.mount(pyodide_js.FS.filesystems.IDBFS, {}, str(cache_dir))
+        await sync_browser_cache(populate=True)
+    except Exception as error:
+        logger.warning("Browser storage is not available, the data is only cached until the page is closed: %s", error)
+
+# Loads the files from IndexedDB (populate=True) or saves them to it (populate=False)
+async def sync_browser_cache(populate):
+    import pyodide_js
+    from pyodide.ffi import create_proxy
+
+    done = asyncio.get_running_loop().create_future()
+    callback = create_proxy(lambda error=None: done.set_result(error))
+    try:
+        pyodide_js.FS.syncfs(populate, callback)
+        error = await done
+    finally:
+        callback.destroy()
+
+    if error:
+        logger.warning("Could not sync the browser cache: %s", error)
+
+# Browser - same as fetch_and_parse with the browser fetch API. The browser decompresses the body and only sends
+# the validators it can read (cross-origin servers must expose them). The body is streamed to the cache file and parsed
+# from there, as the parser can not wait for the chunks of an asynchronous stream
+async def fetch_and_parse_browser(url, parse, cache_dir=data_cache_dir, max_age=None):
+    import pyodide.http
+
+    await mount_browser_cache(cache_dir)
+    metadata = read_cache_metadata(url, cache_dir)
+    body_path, _ = get_cache_paths(url, cache_dir)
+
+    if is_cache_fresh(metadata, max_age):
+        count("fetch.cache_fresh")
+        with open(body_path, "rb") as stream:
+            return parse(stream)
+
+    headers = {name: value for name, value in get_request_headers(metadata).items() if name != "Accept-Encoding"}
+
+    for attempt in range(fetch_retries + 1):
+        if attempt > 0:
+            count("fetch.retries")
+            await asyncio.sleep(retry_backoff * 2 ** (attempt - 1))
+
+        writer = None
+        try:
+            count("fetch.requests")
+            response = await asyncio.wait_for(pyodide.http.pyfetch(url, headers=headers, cache="no-cache"), fetch_timeout)
+
+            if response.status == 304:
+                count("fetch.not_modified")
+                write_cache_metadata(url, {**metadata, "fetched_at": time.time()}, cache_dir)
+                break
+            if response.status >= 500:
+                raise RetryableFetchError(f"HTTP {response.status} {response.status_text}")
+            if not response.ok:
+                raise ConnectionError(f"Fetch Error with STATUS {response.status}. {response.status_text}")
+
+            response_headers = {name.lower(): value for name, value in response.headers.items()}
+            writer = CacheWriter(url, {"ETag": response_headers.get("etag"), "Last-Modified": response_headers.get("last-modified")}, cache_dir)
+            reader = response.js_response.body.getReader()
+            while not (chunk := await asyncio.wait_for(reader.read(), fetch_timeout)).done:
+                writer.write(chunk.value.to_bytes())
+            writer.commit()
+            await sync_browser_cache(populate=False)
+            break
+        except (RetryableFetchError, asyncio.TimeoutError, OSError) as error:
+            if writer is not None:
+                writer.discard()
+            logger.warning("Fetching %s failed (attempt %d of %d): %s", url, attempt + 1, fetch_retries + 1, error)
+        except BaseException:
+            if writer is not None:
+                writer.discard()
+            raise
+    else:
+        body_path = get_stale_copy_path(url, metadata, cache_dir)
+
+    with open(body_path, "rb") as stream:
+        return parse(stream)
+
+# Fetches a URL through the cache and returns parse(stream) of its body. On a server the blocking fetch runs in a
+# worker thread so that it does not block the event loop
+async def fetch_and_parse_async(url, parse, cache_dir=data_cache_dir, max_age=None):
+    with span("fetch"):
+        if running_in_pyodide:
+            return await fetch_and_parse_browser(url, parse, cache_dir, max_age)
+        return await asyncio.to_thread(fetch_and_parse, url, parse, cache_dir, max_age)
+
+# Data assets of the exported site (see app_export.py). The manifest next to app.py maps each asset name to its file,
+# which is named by a hash of its content
+def read_data_manifest():
+    return json.loads((Path(__file__).parent / data_manifest_filename).read_text())
+
+# URL of a data asset - relative to data_assets_url, or in the browser to the site the app was loaded from
+# (the Python worker runs from the shinylive/ directory of the site)
+def get_asset_url(manifest, name):
+    base_url = data_assets_url
+    if base_url is None:
+        if not running_in_pyodide:
+            raise ValueError("Set APP_DATA_ASSETS_URL to the URL of the exported site to load its data assets on a server")
+        import js
+        base_url = urljoin(str(js.location.href), "../")
+
+    return urljoin(base_url if base_url.endswith("/") else base_url + "/", manifest["assets"][name]["file"])
+
+# Fetches a data asset of the exported site and returns parse(stream) of it. The file name changes with the content,
+# so a cached copy never needs to be revalidated
+async def fetch_asset_and_parse_async(name, parse, cache_dir=data_cache_dir):
+    return await fetch_and_parse_async(get_asset_url(read_data_manifest(), name), parse, cache_dir, max_age=float("inf"))
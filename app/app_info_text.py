@@ -4,7 +4,8 @@ info_html = "\
 This dashboard application allows visualisation of a subset of OECD member countries based on \
 how similar or dissimilar they are in terms of diagnoses made on hospital discharge (based on numbers of diagnoses per 100,000 population or female population). \
 There are 20 categories of diagnoses available to be filtered. In addition, the number of clusters to group the countries \
-may be adjusted. These processes of reducing the dataset into two axes to allow visualisation, and the learning of groups/clusters are \
+may be adjusted, and the year slider shows the countries in earlier years - its play button animates the plot through the years \
+(the table always shows the latest numbers). These processes of reducing the dataset into two axes to allow visualisation, and the learning of groups/clusters are \
 both unsupervised Machine Learning algorithms.\
 </p>\
 <p>\
@@ -0,0 +1,78 @@
+# Python modules
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Lightweight opt-in instrumentation: named timing spans around each pipeline stage and event counters.
+# Enable by setting the environment variable APP_PROFILE=1 (or calling enable_profiling()). When enabled:
+#   - every span is logged as one JSON line on the "app.profiling" logger
+#   - totals are shown in a debug panel under the table (see app_ui.py / app_server.py)
+#   - on a Shiny server, totals are served as JSON at /profiling.json (see app.py)
+# When disabled, span() returns a shared no-op context manager and count() returns immediately
+
+logger = logging.getLogger("app.profiling")
+
+profiling_enabled = os.environ.get("APP_PROFILE", "0") not in ("", "0", "false", "False")
+
+# Aggregated timings per span name and counter values, shared by all sessions and threads
+span_stats = {}
+counters = {}
+stats_lock = threading.Lock()
+
+disabled_span = nullcontext()
+
+def enable_profiling(enabled=True):
+    global profiling_enabled
+    profiling_enabled = enabled
+
+    # Structured logs go to stderr unless the logger was configured elsewhere
+    if enabled and not logger.handlers:
+        logger.setLevel(logging.INFO)
+        logger.addHandler(logging.StreamHandler())
+
+# Context manager timing the code inside it, e.g. "with span("embedding"): ..."
+def span(name):
+    if not profiling_enabled:
+        return disabled_span
+    return timed_span(name)
+
+@contextmanager
+def timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        with stats_lock:
+            stats = span_stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["last_ms"] = duration_ms
+
+        logger.info(json.dumps({"span": name, "ms": round(duration_ms, 3), "thread": threading.current_thread().name}))
+
+# Increments a named counter (e.g. number of refits)
+def count(name, increment=1):
+    if not profiling_enabled:
+        return
+
+    with stats_lock:
+        counters[name] = counters.get(name, 0) + increment
+
+# Snapshot of all span timings and counters as a JSON serialisable dictionary
+def get_profile():
+    with stats_lock:
+        spans = {name: {**stats, "mean_ms": stats["total_ms"] / stats["count"]} for name, stats in span_stats.items()}
+        return {"enabled": profiling_enabled, "spans": spans, "counters": dict(counters)}
+
+def reset_profile():
+    with stats_lock:
+        span_stats.clear()
+        counters.clear()
+
+enable_profiling(profiling_enabled)
@@ -0,0 +1,111 @@
+# Python modules
+from pathlib import Path
+from itertools import combinations
+import hashlib
+import numpy as np
+
+# From local files
+from app_variables import diagnoses_categories_map, entity_column
+
+# Precomputed layouts (embedding coordinates and cluster labels) of common category selections, built offline so that
+# the browser only fits selections that are not in the file. Stored as a compressed .npz:
+#   masks       - uint32 bitmask of the selected categories of each layout (bit i = i-th category of diagnoses_categories_map)
+#   coordinates - float32 array (layouts x countries x 2)
+#   labels      - int8 array (layouts x number of clusters x countries), row k-1 holds the labels for k clusters
+#   countries   - country names in the order of the base matrix
+#   categories  - category names in bit order
+#   fingerprint - hash of the base matrix the layouts were fitted on, layouts of other data are not used
+
+category_bits = {category: bit for bit, category in enumerate(diagnoses_categories_map)}
+
+# Path of the layouts file that sits next to the csv file
+def get_layouts_path(csv_path):
+    csv_path = Path(csv_path)
+    return csv_path.with_name(csv_path.stem + "_layouts.npz")
+
+# Bitmask of a selection of categories - the order of the categories does not matter
+def get_category_mask(categories):
+    mask = 0
+    for category in categories:
+        mask |= 1 << category_bits[category]
+    return mask
+
+# Category selections with at most depth categories selected or at most depth categories unselected:
+# every selection reachable from "all selected" (the default) or from one category by up to depth clicks
+def enumerate_category_subsets(depth=2):
+    categories = list(diagnoses_categories_map)
+    sizes = sorted({size for size in range(1, depth + 1)} | {len(categories) - size for size in range(depth + 1)})
+
+    return [list(subset) for size in sizes if 0 < size <= len(categories)
+            for subset in combinations(categories, size)]
+
+# Identifies the exact (float64) base matrix values of the category columns, the values the layouts are fitted on after
+# scaling. The values before scaling are hashed as the scaled ones may differ in the last bits between platforms
+def get_base_fingerprint(base):
+    column_indexes = [base["column_index"][column]
+                      for columns in diagnoses_categories_map.values() for column in columns if column in base["column_index"]]
+    return hashlib.sha1(np.ascontiguousarray(base["values"][:, column_indexes], dtype=np.float64).tobytes()).hexdigest()
+
+# Build step - fits every selection from enumerate_category_subsets and writes the layouts file
+def build_layouts(csv_path, layouts_path=None, depth=2):
+    from app_data_processing import get_local_data, get_base_matrix, fit_category_layout
+
+    if layouts_path is None:
+        layouts_path = get_layouts_path(csv_path)
+
+    df = get_local_data(csv_path)
+    base = get_base_matrix(df)
+    subsets = enumerate_category_subsets(depth)
+
+    coordinates, labels = [], []
+    for subset in subsets:
+        X_reduced, labels_by_num_groups = fit_category_layout(df, subset)
+        coordinates.append(X_reduced)
+        labels.append(labels_by_num_groups)
+
+    np.savez_compressed(layouts_path,
+                        masks=np.array([get_category_mask(subset) for subset in subsets], dtype=np.uint32),
+                        coordinates=np.array(coordinates, dtype=np.float32),
+                        labels=np.array(labels, dtype=np.int8),
+                        countries=np.array(base["countries"][entity_column], dtype=str),
+                        categories=np.array(list(category_bits), dtype=str),
+                        fingerprint=np.array(get_base_fingerprint(base)))
+    return layouts_path, len(subsets)
+
+# Loads a layouts file (path or binary file-like object) for the given base matrix.
+# Returns None if the file is missing or was built for other data
+def load_layouts(layouts_path, base):
+    if isinstance(layouts_path, (str, Path)) and not Path(layouts_path).exists():
+        return None
+
+    with np.load(layouts_path, allow_pickle=False) as layouts:
+        if (str(layouts["fingerprint"]) != get_base_fingerprint(base)
+                or layouts["categories"].tolist() != list(category_bits)
+                or layouts["countries"].tolist() != list(base["countries"][entity_column])):
+            return None
+
+        return {
+            "index": {int(mask): index for index, mask in enumerate(layouts["masks"])},
+            "coordinates": layouts["coordinates"],
+            "labels": layouts["labels"],
+        }
+
+# Precomputed embedding coordinates and labels for every number of clusters, or None if the selection is not in the file
+def get_precomputed_layout(layouts, categories):
+    if layouts is None:
+        return None
+
+    index = layouts["index"].get(get_category_mask(categories))
+    if index is None:
+        return None
+
+    return layouts["coordinates"][index].astype(np.float64), layouts["labels"][index].astype(int)
+
+# Usage: python app_layouts.py [csv_path] [depth]
+if __name__ == "__main__":
+    import sys
+
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else Path(__file__).parent / "OCED_simplified.csv"
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    layouts_path, num_layouts = build_layouts(csv_path, depth=depth)
+    print(f"{num_layouts} layouts written to {layouts_path}")
@@ -0,0 +1,72 @@
+# Python modules
+import numpy as np
+
+# Level of detail rendering of plots with many points (see create_plot). Only a subset of the points is sent to the browser:
+#   - if at most max_points points are in view (e.g. after zooming in) all of them are shown
+#   - otherwise the view is split in a grid of grid_size x grid_size cells and one point is kept per cell and cluster,
+#     so every occupied area of every cluster stays visible
+#   - the points that are labelled (most outlying points in view) and the selected points are always kept
+# The view is (x_min, x_max, y_min, y_max) in plot coordinates
+
+# Outlier score of each point: distance to the center of its cluster, relative to the mean distance in that cluster
+def get_outlier_scores(x, y, labels):
+    points = np.column_stack([x, y]).astype(np.float64)
+    labels = np.asarray(labels, dtype=np.intp)
+    num_labels = labels.max() + 1
+
+    sizes = np.maximum(np.bincount(labels, minlength=num_labels), 1)
+    centers = np.column_stack([np.bincount(labels, weights=points[:, axis], minlength=num_labels)
+                               for axis in range(2)]) / sizes[:, None]
+
+    distances = np.sqrt(((points - centers[labels])**2).sum(axis=1))
+    mean_distances = np.bincount(labels, weights=distances, minlength=num_labels) / sizes
+
+    return distances / np.maximum(mean_distances[labels], np.finfo(np.float64).tiny)
+
+# Fixed random order of the points - each cell keeps its first point in this order, so the kept points of a cell
+# do not change when the view is moved slightly or the selection changes
+def get_point_order(num_points, seed=0):
+    return np.random.default_rng(seed).permutation(num_points)
+
+# Full extent of the points as a view
+def get_extent(x, y):
+    return float(np.min(x)), float(np.max(x)), float(np.min(y)), float(np.max(y))
+
+# Boolean mask of the points inside the view
+def get_points_in_view(x, y, view):
+    x_min, x_max, y_min, y_max = view
+    return (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+
+# Indexes of the num_labels most outlying points in view (scores from get_outlier_scores)
+def get_label_points(scores, in_view, num_labels):
+    candidates = np.flatnonzero(in_view)
+    if len(candidates) > num_labels:
+        candidates = candidates[np.argpartition(-scores[candidates], num_labels)[:num_labels]]
+    return np.sort(candidates)
+
+# Sorted indexes of the points to render for a view, see the top of the file. The grid is made coarser
+# (from grid_size cells per axis) until at most max_points cells are occupied
+def select_view_points(x, y, labels, order, view, max_points, grid_size, always_shown=()):
+    in_view = get_points_in_view(x, y, view)
+    always_shown = np.asarray(always_shown, dtype=np.intp)
+
+    if np.count_nonzero(in_view) <= max_points:
+        return np.flatnonzero(in_view)
+
+    # Points in view in the fixed order - np.unique keeps the first point of each (cell, cluster)
+    ordered = order[in_view[order]]
+    x_min, x_max, y_min, y_max = view
+    cells_x = np.clip((x[ordered] - x_min) / max(x_max - x_min, 1e-12), 0, 1 - 1e-9)
+    cells_y = np.clip((y[ordered] - y_min) / max(y_max - y_min, 1e-12), 0, 1 - 1e-9)
+    ordered_labels = labels[ordered].astype(np.intp)
+    num_labels = int(ordered_labels.max()) + 1
+
+    while True:
+        keys = (((cells_y * grid_size).astype(np.intp) * grid_size + (cells_x * grid_size).astype(np.intp)) * num_labels
+                + ordered_labels)
+        _, first = np.unique(keys, return_index=True)
+        if len(first) <= max_points or grid_size == 1:
+            break
+        grid_size //= 2
+
+    return np.union1d(ordered[first], always_shown[in_view[always_shown]])
@@ -0,0 +1,281 @@
+# Python modules
+import warnings
+import numpy as np
+
+# NumPy implementations of the scikit-learn steps used by the app, for small dense matrices (tens of countries).
+# They give the same results as the scikit-learn classes named in each comment (within floating point tolerance),
+# without importing scikit-learn or SciPy - see model_backend in app_variables.py.
+# Scaling, distances, affinity and embedding also take a batch of matrices (leading axes, e.g. one matrix per year)
+# and process them together
+
+# Median of each column ignoring missing values, used to fill them in (SimpleImputer(strategy="median")).
+# Columns with no data at all are dropped like the imputer does. Returns the imputed array and the kept column indexes
+def impute_median_array(X):
+    X = np.asarray(X, dtype=float)
+    kept_columns = np.flatnonzero(~np.isnan(X).all(axis=0))
+    X = X[:, kept_columns]
+
+    medians = np.nanmedian(X, axis=0)
+    missing_rows, missing_columns = np.nonzero(np.isnan(X))
+    X[missing_rows, missing_columns] = medians[missing_columns]
+
+    return X, kept_columns
+
+# Median imputation of a batch of matrices (e.g. years x countries x columns), each with its own column medians.
+# Columns are not dropped - values of a column with no data at all in a matrix are set to 0
+def impute_median_batch(X):
+    X = np.array(X, dtype=float)
+    missing = np.isnan(X)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # All-NaN columns
+        medians = np.nanmedian(X, axis=-2, keepdims=True)
+
+    X[missing] = np.broadcast_to(np.nan_to_num(medians, nan=0.0), X.shape)[missing]
+    return X
+
+# Zero mean and unit variance for each column (StandardScaler()). Constant columns are only centred
+def standard_scale(X):
+    mean = X.mean(axis=-2, keepdims=True)
+    scale = X.std(axis=-2, keepdims=True)
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+    return (X - mean) / scale
+
+# Squared euclidean distances between all rows of X
+def squared_distances(X):
+    differences = X[..., :, np.newaxis, :] - X[..., np.newaxis, :, :]
+    return np.einsum("...ijk,...ijk->...ij", differences, differences)
+
+# Symmetric k nearest neighbours affinity matrix from squared distances, each point counting as its own neighbour.
+# Same as kneighbors_graph(X, n_neighbors, include_self=True) made symmetric with 0.5 * (A + A.T) in SpectralEmbedding
+def knn_affinity(distances, n_neighbors):
+    n_points = distances.shape[-1]
+    if n_neighbors > n_points:
+        raise ValueError(f"Expected n_neighbors <= n_samples, but n_samples = {n_points}, n_neighbors = {n_neighbors}")
+
+    # Stable sort so that each point comes before other points at distance 0 from it
+    diagonal = np.arange(n_points)
+    distances = distances.copy()
+    distances[..., diagonal, diagonal] = -1
+    neighbours = np.argsort(distances, axis=-1, kind="stable")[..., :n_neighbors]
+
+    connectivity = np.zeros(distances.shape)
+    np.put_along_axis(connectivity, neighbours, 1, axis=-1)
+    return 0.5 * (connectivity + np.swapaxes(connectivity, -1, -2))
+
+# Spectral embedding of an affinity matrix with the normalised graph Laplacian (sklearn.manifold.spectral_embedding).
+# A dense eigendecomposition replaces ARPACK, which is faster and exact for small matrices
+def spectral_embedding(affinity, n_components=2):
+    # Degrees without self loops (scipy.sparse.csgraph.laplacian ignores the diagonal)
+    diagonal = np.arange(affinity.shape[-1])
+    weights = affinity.copy()
+    weights[..., diagonal, diagonal] = 0
+    degrees = weights.sum(axis=-1)
+    dd = np.sqrt(np.where(degrees == 0, 1, degrees))
+
+    laplacian = -weights / dd[..., :, np.newaxis] / dd[..., np.newaxis, :]
+    laplacian[..., diagonal, diagonal] = 1
+
+    # Eigenvectors of the smallest eigenvalues, in ascending order. The first one (constant for a connected graph) is dropped
+    _, eigenvectors = np.linalg.eigh(laplacian)
+    embedding = eigenvectors[..., :, :n_components + 1] / dd[..., :, np.newaxis]
+
+    # Deterministic sign: the largest absolute value of each vector is positive (as _deterministic_vector_sign_flip)
+    max_abs_rows = np.argmax(np.abs(embedding), axis=-2)
+    embedding *= np.sign(np.take_along_axis(embedding, max_abs_rows[..., np.newaxis, :], axis=-2))
+
+    return embedding[..., 1:n_components + 1]
+
+# Merge tree of average linkage clustering of the rows of X (AgglomerativeClustering(linkage="average").children_).
+# Row i holds the two nodes merged at step i, smallest first. Leaves are 0..n-1 and the node created at step i is n+i.
+# Optional weights count each row as that many points (e.g. micro-cluster centers weighted by their number of points).
+# A batch of matrices (leading axes) is clustered together, merging one pair of clusters of every matrix per step
+def average_linkage_children(X, weights=None):
+    n_points = X.shape[-2]
+    batch_shape = X.shape[:-2]
+    distances = np.sqrt(squared_distances(X)).reshape(-1, n_points, n_points)
+    batch = np.arange(distances.shape[0])
+    diagonal = np.arange(n_points)
+    distances[:, diagonal, diagonal] = np.inf
+
+    # Distances between clusters are kept in the rows/columns of the first point of each cluster
+    node_ids = np.tile(np.arange(n_points), (len(batch), 1))
+    sizes = np.ones((len(batch), n_points)) if weights is None else \
+        np.broadcast_to(np.asarray(weights, dtype=float), (len(batch), n_points)).copy()
+    children = np.zeros((len(batch), n_points - 1, 2), dtype=int)
+
+    for step in range(n_points - 1):
+        # Closest pair of clusters - the first minimum in row-major order has first < second
+        first, second = np.divmod(np.argmin(distances.reshape(len(batch), -1), axis=1), n_points)
+        children[:, step] = np.sort(np.column_stack([node_ids[batch, first], node_ids[batch, second]]), axis=1)
+
+        # Average distance of the merged cluster to every other cluster, weighted by cluster sizes
+        first_sizes, second_sizes = sizes[batch, first][:, np.newaxis], sizes[batch, second][:, np.newaxis]
+        merged = (first_sizes * distances[batch, first] + second_sizes * distances[batch, second]) / (first_sizes + second_sizes)
+        merged[batch, first] = np.inf
+        distances[batch, first] = merged
+        distances[batch, :, first] = merged
+        distances[batch, second] = np.inf
+        distances[batch, :, second] = np.inf
+
+        sizes[batch, first] += sizes[batch, second]
+        node_ids[batch, first] = n_points + step
+
+    return children.reshape(*batch_shape, n_points - 1, 2)
+
+# Scalable approximations for large datasets (thousands of entities), used above exact_layout_max_points (app_variables.py).
+# Their cost grows about linearly with the number of points, where the exact methods above grow with its square or cube
+
+# Approximate k nearest neighbours of every row of X, each point being its own first neighbour.
+# Candidates are the nearest points within the leaves of a few random projection trees, refined once by also
+# considering the neighbours of neighbours (as in NN-descent). The cost grows with n_points * leaf_size rather than n_points ** 2
+def approximate_knn(X, n_neighbors, n_trees=8, leaf_size=64, seed=0):
+    n_points = X.shape[0]
+    if n_neighbors > n_points:
+        raise ValueError(f"Expected n_neighbors <= n_samples, but n_samples = {n_points}, n_neighbors = {n_neighbors}")
+
+    rng = np.random.default_rng(seed)
+    leaf_size = max(leaf_size, 2 * n_neighbors)
+    candidate_rows, candidate_cols, candidate_distances = [], [], []
+
+    for _ in range(n_trees):
+        for leaf in random_projection_leaves(X, leaf_size, rng):
+            distances = squared_distances_between(X[leaf], X[leaf])
+            nearest = np.argpartition(distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            candidate_rows.append(np.repeat(leaf, n_neighbors))
+            candidate_cols.append(leaf[nearest].ravel())
+            candidate_distances.append(np.take_along_axis(distances, nearest, axis=1).ravel())
+
+    neighbours = top_k_by_row(np.concatenate(candidate_rows), np.concatenate(candidate_cols),
+                              np.concatenate(candidate_distances), n_points, n_neighbors)
+
+    # Refinement - the neighbours of the neighbours of each point are candidates too (they include the neighbours,
+    # as each point is its own first neighbour). Distances are only computed once per distinct pair
+    pairs = np.unique(np.repeat(np.arange(n_points), n_neighbors * n_neighbors) * n_points + neighbours[neighbours].reshape(-1))
+    rows, cols = np.divmod(pairs, n_points)
+    return top_k_by_row(rows, cols, pair_squared_distances(X.astype(np.float32), rows, cols), n_points, n_neighbors)
+
+# Splits the row indexes of X into leaves of at most leaf_size rows, recursively halving along random directions
+def random_projection_leaves(X, leaf_size, rng):
+    leaves = []
+    to_split = [np.arange(X.shape[0])]
+    while to_split:
+        indexes = to_split.pop()
+        if len(indexes) <= leaf_size:
+            leaves.append(indexes)
+            continue
+        projection = X[indexes] @ rng.standard_normal(X.shape[1])
+        order = np.argsort(projection)
+        to_split += [indexes[order[:len(indexes) // 2]], indexes[order[len(indexes) // 2:]]]
+    return leaves
+
+# Squared distances between the rows of X given by each (rows, cols) pair, a batch of pairs at a time
+def pair_squared_distances(X, rows, cols, batch_size=65536):
+    distances = np.empty(len(rows))
+    for start in range(0, len(rows), batch_size):
+        differences = X[rows[start:start + batch_size]] - X[cols[start:start + batch_size]]
+        distances[start:start + batch_size] = np.einsum("ij,ij->i", differences, differences)
+    return distances
+
+# The k closest distinct candidates (cols) of every row, given as (row, col, squared distance) triples.
+# Each point comes first as its own neighbour
+def top_k_by_row(rows, cols, distances, n_points, k):
+    distances = np.where(rows == cols, -1.0, distances)
+    _, unique = np.unique(rows * n_points + cols, return_index=True)
+    rows, cols, distances = rows[unique], cols[unique], distances[unique]
+
+    order = np.lexsort((distances, rows))
+    row_starts = np.searchsorted(rows[order], np.arange(n_points))
+    return cols[order][row_starts[:, np.newaxis] + np.arange(k)]
+
+# Sparse symmetric affinity 0.5 * (A + A.T) of a k nearest neighbours graph (as knn_affinity), stored as edges sorted
+# by row: rows, cols and weights of each edge and the position of the first edge of each row (CSR format)
+def sparse_knn_affinity(neighbours):
+    n_points, n_neighbors = neighbours.shape
+    rows = np.repeat(np.arange(n_points), n_neighbors)
+    cols = neighbours.ravel()
+
+    # Edges of A and of its transpose with weight 0.5 each - mutual neighbours appear twice and add up to 1
+    edge_keys, edge_counts = np.unique(np.concatenate([rows * n_points + cols, cols * n_points + rows]), return_counts=True)
+    rows, cols = np.divmod(edge_keys, n_points)
+
+    return {
+        "rows": rows,
+        "cols": cols,
+        "weights": 0.5 * edge_counts,
+        "row_starts": np.searchsorted(rows, np.arange(n_points)),
+    }
+
+# Spectral embedding of a sparse affinity (same normalised Laplacian as spectral_embedding).
+# The eigenvectors are found with a block Krylov subspace (block Lanczos with full reorthogonalisation) using only
+# sparse products, instead of a dense eigendecomposition
+def sparse_spectral_embedding(affinity, n_components=2, block_size=4, krylov_steps=40, seed=0):
+    rows, cols, row_starts = affinity["rows"], affinity["cols"], affinity["row_starts"]
+    n_points = len(row_starts)
+
+    # Degrees without self loops, as spectral_embedding
+    weights = np.where(rows == cols, 0, affinity["weights"])
+    degrees = np.bincount(rows, weights=weights, minlength=n_points)
+    dd = np.sqrt(np.where(degrees == 0, 1, degrees))
+    normalised_weights = weights / dd[rows] / dd[cols]
+
+    # Product with the normalised affinity D^-1/2 W D^-1/2 - its largest eigenvalues are the smallest of the Laplacian
+    def multiply(V):
+        return np.add.reduceat(normalised_weights[:, np.newaxis] * V[cols], row_starts, axis=0)
+
+    rng = np.random.default_rng(seed)
+    block, _ = np.linalg.qr(rng.standard_normal((n_points, min(block_size, n_points))))
+    basis = block
+    products = [] # Affinity times each block of the basis, kept for the Rayleigh-Ritz step
+
+    while True:
+        products.append(multiply(block))
+        if len(products) > krylov_steps or basis.shape[1] + block.shape[1] > n_points:
+            break
+
+        # Next block: the product orthogonalised (twice for numerical stability) against the whole basis
+        block = products[-1] - basis @ (basis.T @ products[-1])
+        block -= basis @ (basis.T @ block)
+        block, _ = np.linalg.qr(block)
+        basis = np.hstack([basis, block])
+
+    # Rayleigh-Ritz: eigenvectors of the projection of the affinity on the subspace, largest eigenvalues first
+    projection = basis.T @ np.hstack(products)
+    _, ritz_vectors = np.linalg.eigh(0.5 * (projection + projection.T))
+    embedding = (basis @ ritz_vectors[:, ::-1][:, :n_components + 1]).T / dd
+
+    max_abs_columns = np.argmax(np.abs(embedding), axis=1)
+    embedding *= np.sign(embedding[np.arange(embedding.shape[0]), max_abs_columns])[:, np.newaxis]
+
+    return embedding[1:n_components + 1].T
+
+# Index of the nearest center of every row of X, a chunk of rows at a time
+def nearest_centers(X, centers, chunk_size=4096):
+    return np.concatenate([np.argmin(squared_distances_between(X[start:start + chunk_size], centers), axis=1)
+                           for start in range(0, X.shape[0], chunk_size)])
+
+def squared_distances_between(X, Y):
+    return np.einsum("ij,ij->i", X, X)[:, np.newaxis] - 2 * X @ Y.T + np.einsum("ij,ij->i", Y, Y)
+
+# Mini-batch k-means (as sklearn.cluster.MiniBatchKMeans): each batch moves its centers towards the mean of their
+# points with a per-center learning rate. Returns the centers and the index of the nearest center of every row
+def mini_batch_kmeans(X, n_clusters, batch_size=1024, n_iterations=100, seed=0):
+    rng = np.random.default_rng(seed)
+    n_points, n_dims = X.shape
+    n_clusters = min(n_clusters, n_points)
+
+    centers = X[rng.choice(n_points, n_clusters, replace=False)].astype(float)
+    counts = np.zeros(n_clusters)
+
+    for _ in range(n_iterations):
+        batch = X[rng.choice(n_points, min(batch_size, n_points), replace=False)]
+        nearest = nearest_centers(batch, centers)
+
+        batch_counts = np.bincount(nearest, minlength=n_clusters)
+        batch_sums = np.stack([np.bincount(nearest, weights=batch[:, dim], minlength=n_clusters) for dim in range(n_dims)], axis=1)
+
+        updated = batch_counts > 0
+        counts[updated] += batch_counts[updated]
+        centers[updated] += (batch_sums[updated] - batch_counts[updated, np.newaxis] * centers[updated]) / counts[updated, np.newaxis]
+
+    return centers, nearest_centers(X, centers)
@@ -1,8 +1,17 @@
 # Python modules
-from sklearn.manifold import SpectralEmbedding
-from sklearn.cluster import AgglomerativeClustering
 import bqplot.pyplot as plt
-from bqplot import Tooltip
+from bqplot import Tooltip, OrdinalColorScale, PanZoom
+from heapq import heappush, heappushpop
+import importlib
+import weakref
+import numpy as np
+
+# From local files
+from app_instrumentation import span, count
+from app_numeric import squared_distances, knn_affinity, spectral_embedding, average_linkage_children
+from app_numeric import approximate_knn, sparse_knn_affinity, sparse_spectral_embedding, mini_batch_kmeans
+from app_level_of_detail import get_outlier_scores, get_point_order, get_extent, get_points_in_view, get_label_points, select_view_points
+from app_variables import model_backend
 
 # Integer group to color mapping
 colors_map = {
@@ -15,35 +24,221 @@ colors_map = {
     6:'#3a0ca3', # purple
 }
 
+# Number of nearest neighbours of each country in the embedding graph
+n_neighbors = 12
+
+# Number of micro-clusters of the approximate clustering of large datasets (see fit_clusters_approximate)
+micro_clusters = 256
+
 # Figure Default Styling
 animation_speed = 2000 #ms
 
-# Main plotting function that can either create a new figure or update one (using the "fig" and "update_plot" parameters)
-def create_plot(X_train, countries, num_groups, fig = None, update_plot=False, selected_countries = [], on_select = None):
+# Plots with more points than this are drawn in level of detail mode (see app_level_of_detail.py): only a binned subset
+# of the points in view is sent to the browser, and only some points are labelled
+max_rendered_points = 2000
+lod_grid_size = 64 # Cells per axis of the binning grid
+max_point_labels = 20 # Most outlying points in view labelled, in addition to the selected points
+
+# Fits the 2D embedding of the training data (countries x selected columns)
+def fit_embedding(X_train):
+    if model_backend != "sklearn":
+        return fit_embedding_from_distances(squared_distances(X_train))
+
+    # Imported on first use - scikit-learn is slow to import, so it is kept out of the app start up (see model_modules
+    # in app_data_processing.py, which also explains why there is no import statement)
+    SpectralEmbedding = importlib.import_module("sklearn.manifold").SpectralEmbedding
 
-    global animation_speed
-    
     # Create reduced dimensions for 2D plotting
-    X_reduced = SpectralEmbedding(n_components=2, #2 axes
-                                   n_neighbors=12,
-                                   affinity = "nearest_neighbors",
-                                   random_state=42)\
-                                   .fit_transform(X_train)
+    with span("embedding"):
+        X_reduced = SpectralEmbedding(n_components=2, #2 axes
+                                       n_neighbors=n_neighbors,
+                                       affinity = "nearest_neighbors",
+                                       random_state=42)\
+                                       .fit_transform(X_train)
+    return X_reduced
+
+# Fits the 2D embedding from the squared distances between countries (NumPy backend) - the raw features are not needed
+def fit_embedding_from_distances(distances):
+    with span("embedding"):
+        affinity = knn_affinity(distances, n_neighbors)
+        return spectral_embedding(affinity, n_components=2)
+
+# Builds the average linkage tree once and cuts it for every number of clusters from 1 to max_groups.
+# Returns an integer array of shape (max_groups, number of points) - row k-1 holds the labels for k clusters
+def fit_clusters(X_reduced, max_groups=len(colors_map)):
+    n_leaves = X_reduced.shape[0]
+
+    # The full tree is always computed without connectivity constraints, so n_clusters does not change it
+    with span("clustering"):
+        if model_backend == "sklearn":
+            AgglomerativeClustering = importlib.import_module("sklearn.cluster").AgglomerativeClustering
+            children = AgglomerativeClustering(linkage="average", n_clusters=1).fit(X_reduced).children_
+        else:
+            children = average_linkage_children(X_reduced)
+
+        return cut_tree_by_num_groups(children, n_leaves, max_groups)
+
+# Labels of every number of clusters from 1 to max_groups (at most the number of points), one row per number of clusters
+def cut_tree_by_num_groups(children, n_leaves, max_groups=len(colors_map)):
+    max_groups = min(max_groups, n_leaves)
+
+    return np.array([cut_tree(children, n_leaves, num_groups) 
+                     for num_groups in range(1, max_groups+1)])
+
+# Cuts a tree (AgglomerativeClustering.children_) into num_groups clusters.
+# Splits the most recently merged nodes first and numbers the clusters in the same order as AgglomerativeClustering
+def cut_tree(children, n_leaves, num_groups):
+    # Heap of negated node indexes so that the largest (most recently merged) node is split first
+    nodes = [-(max(children[-1]) + 1)]
+    for _ in range(num_groups - 1):
+        these_children = children[-nodes[0] - n_leaves]
+        heappush(nodes, -these_children[0])
+        heappushpop(nodes, -these_children[1])
+
+    labels = np.zeros(n_leaves, dtype=int)
+    for label, node in enumerate(nodes):
+        labels[get_tree_leaves(-node, children, n_leaves)] = label
+    return labels
+
+# Leaves (original points) below a node of the tree
+def get_tree_leaves(node, children, n_leaves):
+    leaves = []
+    to_visit = [node]
+    while to_visit:
+        node = to_visit.pop()
+        if node < n_leaves:
+            leaves.append(node)
+        else:
+            to_visit.extend(children[node - n_leaves])
+    return leaves
+
+# Fits the embedding and all the clusterings of it. Returns embedding coordinates and labels for each number of clusters
+def fit_layout(X_train):
+    X_reduced = fit_embedding(X_train)
+    return X_reduced, fit_clusters(X_reduced)
+
+# Clustering for large datasets (BIRCH-style): mini-batch k-means groups the points into micro-clusters, whose centers
+# are clustered with average linkage. Labels still nest across numbers of clusters like fit_clusters
+def fit_clusters_approximate(X_reduced, max_groups=len(colors_map)):
+    with span("clustering"):
+        centers, assignment = mini_batch_kmeans(X_reduced, micro_clusters)
+
+        # Drops micro-clusters without points
+        used = np.unique(assignment)
+        centers, assignment = centers[used], np.searchsorted(used, assignment)
+
+        children = average_linkage_children(centers, weights=np.bincount(assignment))
+        max_groups = min(max_groups, len(centers))
+
+        return np.array([cut_tree(children, len(centers), num_groups)[assignment]
+                         for num_groups in range(1, max_groups+1)])
+
+# Layout for large datasets (more than exact_layout_max_points entities): sparse spectral embedding of an approximate
+# nearest neighbours graph and approximate clustering
+def fit_layout_approximate(X_train):
+    with span("embedding"):
+        affinity = sparse_knn_affinity(approximate_knn(X_train, n_neighbors))
+        X_reduced = sparse_spectral_embedding(affinity, n_components=2)
+    return X_reduced, fit_clusters_approximate(X_reduced)
 
-    # Clustering to generate interger labels
-    clustering = AgglomerativeClustering(linkage="average", n_clusters=num_groups)
-    clustering.fit(X_reduced)
+# Same as fit_layout, from the squared distances between countries
+def fit_layout_from_distances(distances):
+    X_reduced = fit_embedding_from_distances(distances)
+    return X_reduced, fit_clusters(X_reduced)
 
-    # Get label colors
-    labels_to_color = [colors_map[label] for label in clustering.labels_]
+# Same as fit_layout_from_distances (NumPy backend) for a batch of distance matrices (e.g. one per year),
+# with the embeddings and linkage trees of every matrix computed together
+def fit_layouts_from_distances(distances):
+    X_reduced = fit_embedding_from_distances(distances)
+    n_leaves = X_reduced.shape[1]
+
+    with span("clustering"):
+        children = average_linkage_children(X_reduced)
+        labels_by_num_groups = np.array([cut_tree_by_num_groups(these_children, n_leaves) for these_children in children])
+
+    return X_reduced, labels_by_num_groups
+
+# Rotation or reflection of the embedding X that best matches the reference embedding (orthogonal Procrustes).
+# Spectral embeddings are only defined up to the sign and order of their axes, which can flip between similar data
+def align_embedding(X, reference):
+    u, _, vt = np.linalg.svd((X - X.mean(axis=0)).T @ (reference - reference.mean(axis=0)))
+    return X @ (u @ vt)
+
+# Renumbers the clusters of labels to match the reference labels of the same points (largest overlaps first),
+# so that a cluster keeps its color between layouts
+def match_labels(labels, reference):
+    num_labels = int(max(labels.max(), reference.max())) + 1
+    overlaps = np.bincount(labels * num_labels + reference, minlength=num_labels**2)
+
+    mapping = np.full(num_labels, -1)
+    used = np.zeros(num_labels, dtype=bool)
+    for pair in np.argsort(-overlaps, kind="stable"):
+        label, reference_label = divmod(pair, num_labels)
+        if mapping[label] < 0 and not used[reference_label]:
+            mapping[label] = reference_label
+            used[reference_label] = True
+
+    return mapping[labels]
+
+# Aligns a sequence of layouts (e.g. consecutive years) so that points move and change color as little as possible
+# from one layout to the next. The anchor layout is kept as is and each other layout is aligned to its neighbour towards it
+def align_layouts(X_reduced, labels_by_num_groups, anchor):
+    X_reduced, labels_by_num_groups = X_reduced.copy(), labels_by_num_groups.copy()
+
+    for step in (-1, 1):
+        for index in range(anchor + step, -1 if step < 0 else len(X_reduced), step):
+            neighbour = index - step
+            X_reduced[index] = align_embedding(X_reduced[index], X_reduced[neighbour])
+            labels_by_num_groups[index] = [match_labels(labels, reference) for labels, reference
+                                           in zip(labels_by_num_groups[index], labels_by_num_groups[neighbour])]
+
+    return X_reduced, labels_by_num_groups
+
+# Color scale mapping the integer cluster labels of the points to colors_map - the labels are sent to the browser
+# as a compact integer array instead of one hex string per point
+def make_color_scale():
+    return OrdinalColorScale(colors=list(colors_map.values()), domain=list(colors_map.keys()))
+
+# True if a trait value is unchanged (NumPy arrays are compared by value)
+def trait_equal(current, new):
+    if isinstance(current, np.ndarray) or isinstance(new, np.ndarray):
+        return (current is not None and new is not None
+                and np.shape(current) == np.shape(new) and np.array_equal(current, new))
+    return current == new
+
+# Sets only the traits that differ from the current values of the widget, in one message.
+# Every trait assignment otherwise sends the full value over the comm channel, even if it is unchanged
+def sync_changed_traits(widget, **traits):
+    changed = {name: value for name, value in traits.items() if not trait_equal(getattr(widget, name), value)}
+
+    if changed:
+        with widget.hold_sync():
+            for name, value in changed.items():
+                setattr(widget, name, value)
+
+    count("plot.traits_synced", len(changed))
+    return changed
+
+# Main plotting function that can either create a new figure or update one (using the "fig" and "update_plot" parameters)
+# X_reduced are the embedding coordinates and labels the cluster labels for the chosen number of clusters
+def create_plot(X_reduced, labels, countries, fig = None, update_plot=False, selected_countries = [], on_select = None):
+
+    global animation_speed
+
+    # Typed arrays - float32 coordinates and int8 labels are sent as compact binary buffers
+    labels = np.asarray(labels, dtype=np.int8)
 
     # Get axis coordinates
-    x_axis = X_reduced[:, 0]
-    y_axis = X_reduced[:, 1]
+    x_axis = np.asarray(X_reduced[:, 0], dtype=np.float32)
+    y_axis = np.asarray(X_reduced[:, 1], dtype=np.float32)
 
     # Create new figure if update_plot is False
     if update_plot==False:
-        fig= plt.figure(figsize=(6, 6),animation_duration=animation_speed)
+        names = np.asarray(countries, dtype=str).ravel()
+        level_of_detail = len(names) > max_rendered_points
+
+        # No animation in level of detail mode - the rendered points change with the view
+        fig= plt.figure(figsize=(6, 6),animation_duration=0 if level_of_detail else animation_speed)
 
         # Tooltip - hover for name
         tooltip = Tooltip(fields=["name"], formats=[""])
@@ -51,31 +246,47 @@ def create_plot(X_train, countries, num_groups, fig = None, update_plot=False, s
         # Axes
         axes_options = {
             "x":{"label":"Reduced Dimension X","tick_style":{"display":"none"}},
-            "y":{"label":"Reduced Dimension Y","tick_style":{"display":"none"}}
+            "y":{"label":"Reduced Dimension Y","tick_style":{"display":"none"}},
+            "color":{"visible":False},
         }
 
-        # Scatterplot
-        scatterplot = plt.scatter(x_axis, y_axis, 
-                    colors=labels_to_color,
-                    names=countries,
-                    display_names=True,
-                    apply_clip=False,
+        # Scatterplot - colored by cluster label. In level of detail mode the points are set by render_level_of_detail
+        # and are clipped to the view when zoomed in
+        shown = slice(0) if level_of_detail else slice(None)
+        scatterplot = plt.scatter(x_axis[shown], y_axis[shown], 
+                    color=labels[shown],
+                    scales={"color":make_color_scale()},
+                    names=names[shown],
+                    display_names=not level_of_detail,
+                    apply_clip=level_of_detail,
                     tooltip=tooltip,
                     axes_options=axes_options
                     )
+        set_plot_points(scatterplot, x_axis, y_axis, labels, names=names)
 
         # Register click callback that updates Reactive value in the server
         scatterplot.on_element_click(on_select)
 
         # Scatterplot - only showing the stroke as a ring highliting selected points
         highlights = plt.scatter(
-            x =[],
-            y=[],
+            x =np.array([], dtype=np.float32),
+            y=np.array([], dtype=np.float32),
             default_size=200,
             fill=False,
             stroke="black",
             axes_options=axes_options
         )
+
+        # Level of detail mode - labels of the selected and most outlying points in view, instead of all the point names
+        if level_of_detail:
+            plt.label(np.array([], dtype=str),
+                      x=np.array([], dtype=np.float32),
+                      y=np.array([], dtype=np.float32),
+                      default_size=12,
+                      x_offset=8,
+                      axes_options=axes_options
+                      )
+            render_level_of_detail(fig)
         
         return fig
 
@@ -87,82 +298,195 @@ def create_plot(X_train, countries, num_groups, fig = None, update_plot=False, s
         # Figure object passed as fig and the plt.scatter object within "marks" attribute. 
         scatterplot = fig.marks[0]
         highlights = fig.marks[1]
-        
-        num_points = len(scatterplot.x)
 
-        # Update plot within context manager hold_sync() for simultaneous updating
-        with fig.hold_sync():
-            # New coordinates after reprocessing and retraining the data
-            scatterplot.x = x_axis
-            scatterplot.y = y_axis
-            
-            # New cluster labels and colors
-            scatterplot.colors=labels_to_color
-            
-            # Reset styling
-            fig.title=""
-            scatterplot.opacities = [1]*num_points
-            highlights.opacities = [1]*num_points
-            scatterplot.display_names = True
-            
-            # Update highlight circle positions
-            plot_highlight_circle(fig, selected_countries)
+        points, moved = set_plot_points(scatterplot, x_axis, y_axis, labels)
+
+        # Only the changed traits are sent, e.g. the coordinates are unchanged when only the number of clusters changed.
+        # Also resets the styling of an empty plot (see empty_plot_with_title)
+        sync_changed_traits(fig, title="")
+        sync_changed_traits(highlights, opacities=np.array([1.0]))
+
+        if points["level_of_detail"]:
+            # The zoom of the previous coordinates does not apply to new ones - shows all the points again
+            if moved:
+                sync_changed_traits(scatterplot.scales["x"], min=None, max=None)
+                sync_changed_traits(scatterplot.scales["y"], min=None, max=None)
+            sync_changed_traits(scatterplot, opacities=np.array([1.0]))
+            sync_changed_traits(fig.marks[2], visible=True)
+        else:
+            sync_changed_traits(scatterplot, x=x_axis, y=y_axis, color=labels, opacities=np.array([1.0]), display_names=True)
+
+        # Update highlight circle positions
+        plot_highlight_circle(fig, selected_countries)
+
+# Color of each country in the figure, from its cluster label
+def get_country_colors(fig):
+    points = plot_points[fig.marks[0]]
+    return {name: colors_map[int(label)] for name, label in zip(points["names"], points["labels"])}
+
+# All the points of each scatterplot (names, coordinates, labels and a name -> point index), as in level of detail mode
+# the scatterplot only holds the points rendered for the current view. The names of a figure never change
+plot_points = weakref.WeakKeyDictionary()
+
+# Point indexes currently highlighted by each highlights mark (in highlight order), with the x coordinates they were taken from
+highlighted_points = weakref.WeakKeyDictionary()
+
+# Stores the points of a new layout. Returns the points and whether the coordinates changed.
+# Unchanged coordinates keep the same arrays, so that highlights are updated incrementally (see plot_highlight_circle)
+def set_plot_points(scatterplot, x_axis, y_axis, labels, names=None):
+    points = plot_points.get(scatterplot)
+    if points is None:
+        points = {
+            "names": names,
+            "index": {name: index for index, name in enumerate(names)},
+            "level_of_detail": len(names) > max_rendered_points,
+            "order": get_point_order(len(names)),
+            "x": None,
+            "y": None,
+        }
+        plot_points[scatterplot] = points
+
+    moved = not (trait_equal(points["x"], x_axis) and trait_equal(points["y"], y_axis))
+    if moved:
+        points["x"], points["y"] = x_axis, y_axis
+    points["labels"] = labels
+
+    if points["level_of_detail"]:
+        points["scores"] = get_outlier_scores(points["x"], points["y"], labels)
+
+    return points, moved
+
+# True if the figure is drawn in level of detail mode (more than max_rendered_points points)
+def is_level_of_detail_plot(fig):
+    return fig is not None and len(fig.marks) > 0 and plot_points[fig.marks[0]]["level_of_detail"]
+
+# Level of detail mode - sends the subset of the points in view (see app_level_of_detail.py) and their labels.
+# The view is the domain of the x and y scales (set by pan and zoom), or all the points if not zoomed in
+def render_level_of_detail(fig, selected_countries=[]):
+    scatterplot = fig.marks[0]
+    labels_mark = fig.marks[2]
+    points = plot_points[scatterplot]
+    x_axis, y_axis = points["x"], points["y"]
+
+    x_scale, y_scale = scatterplot.scales["x"], scatterplot.scales["y"]
+    view = tuple(extent if scale_limit is None else scale_limit
+                 for extent, scale_limit in zip(get_extent(x_axis, y_axis), (x_scale.min, x_scale.max, y_scale.min, y_scale.max)))
+
+    with span("plot.level_of_detail"):
+        # Selected points are always shown, so that their highlight can be clicked to remove them from the selection
+        selected = [points["index"][country] for country in selected_countries if country in points["index"]]
+        labelled = np.union1d(get_label_points(points["scores"], get_points_in_view(x_axis, y_axis, view), max_point_labels),
+                              np.array(selected, dtype=np.intp))
+        rendered = select_view_points(x_axis, y_axis, points["labels"], points["order"], view,
+                                      max_rendered_points, lod_grid_size, always_shown=labelled)
+
+        sync_changed_traits(scatterplot, x=x_axis[rendered], y=y_axis[rendered], color=points["labels"][rendered],
+                            names=points["names"][rendered])
+        sync_changed_traits(labels_mark, x=x_axis[labelled], y=y_axis[labelled], text=points["names"][labelled])
+
+    count("plot.points_rendered", len(rendered))
+
+# Selection model: the selected countries are an insertion ordered dict (country -> None), i.e. an ordered set with
+# constant time membership, add and remove. Returns a new dict with the country added or removed
+def toggle_selection(selected_countries, country):
+    selected_countries = dict(selected_countries)
+    if country in selected_countries:
+        del selected_countries[country]
+    else:
+        selected_countries[country] = None
+    return selected_countries
 
 # Plots a highlight circle around selected country
 def plot_highlight_circle(fig, selected_countries=[]):
-    global animation_speed
-
     # Figure object passed as fig and the plt.scatter object within "marks" attribute. 
     scatterplot = fig.marks[0]
     highlights = fig.marks[1]
 
-    # Index positions in the scatterplot of selected countries
-    indexes = [index for index in range(len(scatterplot.x)) 
-               if scatterplot.names[index] in selected_countries]
+    # Level of detail mode - the selected points are always rendered
+    if is_level_of_detail_plot(fig):
+        render_level_of_detail(fig, selected_countries)
 
-    # Build updated positions
-    x_positions, y_positions = [],[]
-    for index in indexes:
-        x_positions.append(scatterplot.x[index])
-        y_positions.append(scatterplot.y[index])
+    # Index positions of selected countries in all the points of the scatterplot
+    points = plot_points[scatterplot]
+    point_index = points["index"]
+    selected_indexes = {point_index[country]: None for country in selected_countries if country in point_index}
+
+    # Build updated positions. If the points did not move since the last call, only the highlights of countries
+    # added to or removed from the selection are changed (e.g. a click adds or removes one highlight)
+    previous_indexes, previous_x = highlighted_points.get(highlights, ([], None))
+
+    if previous_x is points["x"]:
+        previous = set(previous_indexes)
+        kept = [position for position, index in enumerate(previous_indexes) if index in selected_indexes]
+        added = [index for index in selected_indexes if index not in previous]
+        indexes = [previous_indexes[position] for position in kept] + added
+        x_positions = np.concatenate([highlights.x[kept], points["x"][added]]).astype(np.float32)
+        y_positions = np.concatenate([highlights.y[kept], points["y"][added]]).astype(np.float32)
+    else:
+        indexes = list(selected_indexes)
+        x_positions = points["x"][indexes]
+        y_positions = points["y"][indexes]
 
-    # Update the plot in-place, within context manager hold_sync() for simultaneous updating.
-    # No animation when updating highlights on/off
+    highlighted_points[highlights] = (indexes, points["x"])
+
+    # Nothing to send (and no animation toggling) if the highlights did not move
+    if trait_equal(highlights.x, x_positions) and trait_equal(highlights.y, y_positions):
+        return
+
+    # Update the plot in-place, in one message. No animation when updating highlights on/off
+    animation_duration = fig.animation_duration
     fig.animation_duration=0
     
-    with fig.hold_sync():
-        highlights.x=x_positions
-        highlights.y=y_positions
+    with span("plot.highlight_sync"):
+        sync_changed_traits(highlights, x=x_positions, y=y_positions)
         
-    fig.animation_duration=animation_speed
+    fig.animation_duration=animation_duration
 
 # Toggles display of labels on/off
 def toggle_plot_labels(fig):
     scatterplot = fig.marks[0]
 
+    # Level of detail mode - labels are a separate mark
+    if is_level_of_detail_plot(fig):
+        fig.marks[2].visible = not fig.marks[2].visible
+        return
+
     scatterplot.display_names = not scatterplot.display_names
+
+# Pan and zoom interaction of each figure, created on first use
+plot_zooms = weakref.WeakKeyDictionary()
+
+# Toggles pan (drag) and zoom (mouse wheel) on/off. Points can not be clicked while it is on - the view is kept when it is
+# turned off, so that points found by zooming in can then be selected. Level of detail plots refine the points shown
+# to the view (see render_level_of_detail)
+def toggle_plot_zoom(fig):
+    scatterplot = fig.marks[0]
+
+    if fig.interaction is not None:
+        fig.interaction = None
+        return
+
+    if fig not in plot_zooms:
+        plot_zooms[fig] = PanZoom(scales={"x": [scatterplot.scales["x"]], "y": [scatterplot.scales["y"]]})
+    fig.interaction = plot_zooms[fig]
     
         
 # Changes a figure in-place to empty plot, and display an error message as the plot title
 def empty_plot_with_title(title="Something Went Wrong :(", fig = None):
     if not fig:
         return
-
-    global animation_speed
         
     scatterplot = fig.marks[0]
     highlights = fig.marks[1]
 
-    num_points = len(scatterplot.x)
-
-    # Update the plot in-place, within context manager hold_sync() for simultaneous updating
-    # Do not animate the changes
+    # Update the plot in-place, do not animate the changes
+    animation_duration = fig.animation_duration
     fig.animation_duration=0
-    
-    with fig.hold_sync():
-        fig.title=title
-        scatterplot.opacities = [0]*num_points # Hide current points
-        highlights.opacities = [0]*num_points # Hide current highlights
-        scatterplot.display_names = False
 
-    fig.animation_duration=animation_speed    
\ No newline at end of file
+    sync_changed_traits(fig, title=title)
+    sync_changed_traits(scatterplot, opacities=np.array([0.0]), display_names=False) # Hide current points
+    sync_changed_traits(highlights, opacities=np.array([0.0])) # Hide current highlights
+    if is_level_of_detail_plot(fig):
+        sync_changed_traits(fig.marks[2], visible=False) # Hide current labels
+
+    fig.animation_duration=animation_duration
@@ -0,0 +1,52 @@
+# Python modules
+import time
+from shiny import reactive
+
+# Decorator that coalesces a burst of reactive changes into a single update.
+# The decorated function is read like a reactive calculation but only changes once its inputs have stayed
+# unchanged for delay_secs (e.g. "Select All" updating two checkbox groups one after the other).
+# The first value is passed through immediately so the initial render is not delayed.
+# Must be called within a server function (session context) as it registers reactive effects.
+def debounce(delay_secs):
+    def wrapper(func):
+        latest = reactive.Calc(func)
+        debounced_value = reactive.Value(None)
+        deadline = reactive.Value(None)
+        first_value = True
+
+        # Every change of the inputs (re)starts the timer
+        @reactive.Effect(priority=102)
+        def restart_timer():
+            nonlocal first_value
+            value = latest()
+
+            if first_value:
+                first_value = False
+                debounced_value.set(value)
+                return
+
+            with reactive.isolate():
+                deadline.set(time.monotonic() + delay_secs)
+
+        # Publishes the latest value once the timer runs out, only invalidating dependents if the value changed
+        @reactive.Effect(priority=101)
+        def publish_when_settled():
+            time_left = deadline() - time.monotonic() if deadline() is not None else None
+            if time_left is None:
+                return
+
+            if time_left > 0:
+                reactive.invalidate_later(time_left)
+                return
+
+            with reactive.isolate():
+                deadline.set(None)
+                value = latest()
+                if value != debounced_value.get():
+                    debounced_value.set(value)
+
+        def debounced():
+            return debounced_value.get()
+
+        return debounced
+    return wrapper
@@ -1,58 +1,121 @@
 # Python modules
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
 from shiny import render, reactive, ui
 from shinywidgets import register_widget, reactive_read
 import bqplot.pyplot as plt
 
 # From local files
-from app_data_processing import train_and_get_plot, train_and_update_plot
-from app_table_generation import create_table
-from app_plotting import plot_highlight_circle, toggle_plot_labels
+from app_data_processing import train_and_get_plot, train_and_update_plot, fit_plot_layout, update_plot_layout, get_profiling_report, preload_model_modules
+from app_data_processing import load_table_data_async
+from app_table_generation import create_table, create_full_table, get_table_visibility, is_client_side_table
+from app_plotting import plot_highlight_circle, toggle_plot_labels, toggle_plot_zoom, get_country_colors, toggle_selection
+from app_plotting import is_level_of_detail_plot, render_level_of_detail
 from app_ui import left_categories, right_categories
 from app_info_text import info_html
+from app_variables import running_in_pyodide, input_debounce_delay
+from app_reactive import debounce
+from app_instrumentation import profiling_enabled
+
+# Worker thread for model fitting on a Shiny server, so that fitting does not block the event loop.
+# Not used in Pyodide (no threads in the browser) where fitting stays synchronous
+plot_fit_executor = None if running_in_pyodide else ThreadPoolExecutor(max_workers=1)
+
+# Background import of the modelling modules, started by the first session (i.e. after the UI page has been served)
+model_modules_preload = None
 
 def server(input, output, session):
+    global model_modules_preload
+
+    # On a Shiny server the modelling modules are imported in the worker thread while the session starts up.
+    # In Pyodide they are imported by the first fit instead, after the UI is shown
+    if plot_fit_executor is not None and model_modules_preload is None:
+        model_modules_preload = plot_fit_executor.submit(preload_model_modules)
+
     # Variable store of figure object - allows updating in place (more efficient and allows animation) rather than re-rendering the plot
     fig_object = None
-    selected_countries = reactive.Value([])
+    # Incremented on every plot update request - only the layout fitted for the latest request is applied to the figure
+    fit_generation = 0
+    # Selected countries in the order they were clicked - an ordered set (dict of country -> None), see toggle_selection
+    selected_countries = reactive.Value({})
     country_to_color = reactive.Value({})
+    # Categories currently shown in the plot - set together with country_to_color so the table renders once per plot update
+    plotted_categories = reactive.Value([])
+    # Set to True once the data has been loaded and plotted
+    data_loaded = reactive.Value(False)
+    # Set to True once the data only shown in the table has been loaded too (see load_table_data)
+    table_data_ready = reactive.Value(False)
+    # Background load of the table data in the browser (see load_table_data_in_background)
+    table_data_load = None
     
     # Selects and removes countries when clicking on the plot
     def on_select_callback(*args):
         clicked_name = args[1].get("data").get("name")
-        selected_copy = selected_countries.get()[:]
 
         # Add or remove the clicked country from selected countries
-        if clicked_name in selected_copy:
-            selected_copy.remove(clicked_name)
-        else:
-            selected_copy.append(clicked_name)
-            
-        selected_countries.set(selected_copy)
+        selected_countries.set(toggle_selection(selected_countries.get(), clicked_name))
     
+    @debounce(input_debounce_delay)
+    # Category, cluster and year inputs - changes within input_debounce_delay of each other are coalesced into one plot update
+    def plot_inputs():
+        categories_selected = input.diagnosis_categories_left() + input.diagnosis_categories_right()
+        return categories_selected, input.num_groups(), input.year()
+
     @reactive.Effect
-    @reactive.event(input.diagnosis_categories_left, input.diagnosis_categories_right, input.num_groups)
+    @reactive.event(plot_inputs)
     # Creates the plot if does not exist, otherwise updates it in-place in response to changes in selection by user
     async def create_and_update_plot():
-        nonlocal fig_object
+        nonlocal fig_object, fit_generation
         
         # Reactive inputs
-        categories_selected = input.diagnosis_categories_left() + input.diagnosis_categories_right()
-        num_groups = input.num_groups()
+        categories_selected, num_groups, year = plot_inputs()
 
         # Creates fig object - await because on first call it will fetch the raw data using http request
         if fig_object is None:
-            fig = await train_and_get_plot(categories = categories_selected, num_groups = num_groups, on_select_callback = on_select_callback)
+            fig = await train_and_get_plot(categories = categories_selected, num_groups = num_groups, on_select_callback = on_select_callback, year = year)
             # Register figure to be shown and store figure in variable for in-place modification
             register_widget("plot_output", fig)
             fig_object = fig 
-        else:
+        elif running_in_pyodide:
             # Use stored figure object to update plot in-place
-            train_and_update_plot(fig_object, categories = categories_selected, selected_countries=selected_countries.get(), num_groups = num_groups)
+            train_and_update_plot(fig_object, categories = categories_selected, selected_countries=selected_countries.get(), num_groups = num_groups, year = year)
+        else:
+            # Fit in the background - the figure is updated by apply_fitted_plot_layout when the fit finishes.
+            # Cancels the running fit and any queued fits as they are superseded by this request
+            fit_generation += 1
+            fit_plot_layout_task.cancel()
+            fit_plot_layout_task(fit_generation, categories_selected, num_groups, year)
+            return
+
+        update_plot_state(categories_selected)
+
+    # Retrieve the color mapping from fig and update country_to_color and the plotted categories
+    def update_plot_state(categories):
+        colors = get_country_colors(fig_object)
+        country_to_color.set(colors)
+        plotted_categories.set(categories)
+        data_loaded.set(len(colors) > 0)
+
+    if not running_in_pyodide:
+        @reactive.extended_task
+        # Fits the layout in the worker thread without blocking the event loop
+        async def fit_plot_layout_task(generation, categories, num_groups, year):
+            loop = asyncio.get_running_loop()
+            layout = await loop.run_in_executor(plot_fit_executor, fit_plot_layout, categories, num_groups, year)
+            return generation, categories, layout
 
-        # Retrieve the color mapping from fig and update country_to_color
-        colors_list = fig_object.marks[0].colors
-        countries = fig_object.marks[0].names
-        country_to_color.set(dict(zip(countries,colors_list)))
+        @reactive.Effect
+        # Updates the plot in-place once a background fit finishes, dropping results of superseded requests
+        def apply_fitted_plot_layout():
+            generation, categories, layout = fit_plot_layout_task.result()
+
+            if generation != fit_generation:
+                return
+
+            with reactive.isolate():
+                update_plot_layout(fig_object, layout, categories=categories, selected_countries=selected_countries.get())
+                update_plot_state(categories)
 
     @reactive.Effect
     @reactive.event(selected_countries)
@@ -85,26 +148,115 @@ def server(input, output, session):
     def toggle_labels():
         toggle_plot_labels(fig_object)
 
+    @reactive.Effect
+    @reactive.event(input.toggle_zoom_button)
+    def toggle_zoom():
+        toggle_plot_zoom(fig_object)
+
+    @reactive.Effect
+    # Level of detail plots (many points) - shows the points and labels of the area in view after a pan or zoom
+    def refine_plot_view():
+        if not data_loaded.get() or not is_level_of_detail_plot(fig_object):
+            return
+
+        scatterplot = fig_object.marks[0]
+        reactive_read(scatterplot.scales["x"], ["min", "max"])
+        reactive_read(scatterplot.scales["y"], ["min", "max"])
+
+        with reactive.isolate():
+            render_level_of_detail(fig_object, selected_countries.get())
+
+    # Loads the columns only shown in the table (the category summary columns) without holding up the plot.
+    # In the exported site they are a separate data asset, fetched once the plot is shown. If they can not be loaded
+    # the table is shown without them
+    async def load_table_data():
+        try:
+            await load_table_data_async()
+        except Exception as e:
+            print(e)
+        return True
+
+    if running_in_pyodide:
+        # No extended tasks in the Shinylive runtime - the load runs as an asyncio task, so the flush that shows the
+        # plot does not wait for it, and sets table_data_ready under the reactive lock when it finishes
+        async def load_table_data_in_background():
+            ready = await load_table_data()
+            async with reactive.lock():
+                table_data_ready.set(ready)
+                await reactive.flush()
+
+        @reactive.Effect
+        @reactive.event(data_loaded)
+        def start_table_data_load():
+            nonlocal table_data_load
+            if data_loaded.get() and table_data_load is None:
+                table_data_load = asyncio.create_task(load_table_data_in_background())
+    else:
+        @reactive.extended_task
+        async def load_table_data_task():
+            return await load_table_data()
+
+        @reactive.Effect
+        @reactive.event(data_loaded)
+        def start_table_data_load():
+            if data_loaded.get() and load_table_data_task.status() == "initial":
+                load_table_data_task()
+
+        @reactive.Effect
+        def finish_table_data_load():
+            table_data_ready.set(load_table_data_task.result())
+
     @reactive.Effect
     @reactive.event(input.clear_country_selection_button)
     def clear_country_selection():
-        selected_countries.set([])     
+        selected_countries.set({})
 
     @output
-    @render.table(index=True)
-    @reactive.event(input.diagnosis_categories_left,input.diagnosis_categories_right,selected_countries,country_to_color)
+    @render.ui
+    # Only reads the values it depends on in the table mode used (see is_client_side_table)
     def table_output():
-        # Reactive inputs
-        categories_selected = input.diagnosis_categories_left() + input.diagnosis_categories_right()
+        if not table_data_ready.get():
+            return None
+
+        # Client-side table - the full table is only sent once, as it does not depend on the selection. Which countries
+        # and rows are shown is then updated by send_table_visibility
+        if is_client_side_table():
+            table = create_full_table()
+            return ui.HTML(table) if table else None
+
+        # Reactive inputs - the rows collapsed in the browser do not trigger a render
+        categories_selected = plotted_categories.get()
         countries = selected_countries.get()
-        rows_hidden_state = input.row_indexes_to_hide()
+        with reactive.isolate():
+            rows_hidden_state = input.row_indexes_to_hide()
 
-        # Table is a Styler object from pandas
+        # Table is HTML built from pre-rendered fragments (None if nothing to show)
         table = create_table(categories = categories_selected, 
                              countries_selected = countries, 
                              country_to_color = country_to_color.get(),
                              rows_hidden_state = rows_hidden_state)
-        return table
+        return ui.HTML(table) if table else None
+
+    @reactive.Effect
+    @reactive.event(plotted_categories,selected_countries,country_to_color,table_data_ready)
+    # Sends the small visibility and header color payload, applied in-place by table_interactivity.js
+    async def send_table_visibility():
+        if not table_data_ready.get() or not is_client_side_table():
+            return
+
+        visibility = get_table_visibility(categories = plotted_categories.get(),
+                                          countries_selected = selected_countries.get(),
+                                          country_to_color = country_to_color.get())
+        if visibility:
+            await session.send_custom_message("table_visibility", visibility)
+
+    if profiling_enabled:
+        @output
+        @render.text
+        # Profiling timings for the debug panel, refreshed every 2 seconds
+        def profiling_output():
+            reactive.invalidate_later(2)
+            return json.dumps(get_profiling_report(), indent=2)
 
     @reactive.Effect
     @reactive.event(input.show_info_button)
@@ -0,0 +1,96 @@
+# Python modules
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# From local files
+from app_variables import diagnoses_categories_map, diagnoses_categories_map_aggregates, data_encoding, entity_column
+
+# Binary snapshot of the raw csv data - only the columns used by the app are kept.
+# Stored as a compressed .npz with a float64 matrix of values and the indexes needed to rebuild the dataframe:
+#   values    - float64 matrix (rows x diagnosis columns), the values parsed from the csv exactly, so the app gives the
+#               same results with or without the snapshot
+#   columns   - diagnosis column names
+#   countries - unique entity (country) names
+#   country_codes - index into countries for each row
+#   years     - year of each row
+#   source_size, source_hash - size and sha1 of the csv file it was built from, a snapshot of another version of the csv
+#                              is not used (see is_snapshot_current)
+
+# All diagnosis columns used by the model and the table (category columns followed by summary columns)
+def get_snapshot_columns():
+    columns = []
+    for category_columns in diagnoses_categories_map.values():
+        columns += category_columns
+    columns += [column for column in diagnoses_categories_map_aggregates.values() if column not in columns]
+    return columns
+
+# Path of the snapshot file that sits next to the csv file
+def get_snapshot_path(csv_path):
+    return Path(csv_path).with_suffix(".npz")
+
+# sha1 of the content of the csv file
+def get_source_hash(csv_path):
+    return hashlib.sha1(Path(csv_path).read_bytes()).hexdigest()
+
+# Arrays of the snapshot of the given columns (all the columns used by the app by default) of the csv file
+def get_snapshot_arrays(csv_path, columns=None):
+    if columns is None:
+        columns = get_snapshot_columns()
+
+    df = pd.read_csv(csv_path, encoding=data_encoding)
+    country_codes, countries = pd.factorize(df[entity_column])
+
+    return {
+        "values": df[columns].to_numpy(dtype=np.float64),
+        "columns": np.array(columns, dtype=str),
+        "countries": np.array(countries, dtype=str),
+        "country_codes": country_codes.astype(np.int16 if len(countries) < 2**15 else np.int32),
+        "years": df["year"].to_numpy(dtype=np.int16),
+        "source_size": np.array(Path(csv_path).stat().st_size, dtype=np.int64),
+        "source_hash": np.array(get_source_hash(csv_path)),
+    }
+
+# Build step - reads the csv once and writes the snapshot file
+def build_snapshot(csv_path, snapshot_path=None):
+    if snapshot_path is None:
+        snapshot_path = get_snapshot_path(csv_path)
+
+    np.savez_compressed(snapshot_path, **get_snapshot_arrays(csv_path))
+    return snapshot_path
+
+# True if the snapshot file was built from the csv file as it is now and has all the given columns (year and entity
+# columns aside). The hash is only computed if the size matches. Without the csv there is nothing to check against
+def is_snapshot_current(snapshot_path, csv_path, columns):
+    with np.load(snapshot_path, allow_pickle=False) as snapshot:
+        if "source_hash" not in snapshot.files:
+            return False
+        if not set(columns) - {"year", entity_column} <= set(snapshot["columns"].tolist()):
+            return False
+        source_size, source_hash = int(snapshot["source_size"]), str(snapshot["source_hash"])
+
+    csv_path = Path(csv_path)
+    if not csv_path.exists():
+        return True
+    return csv_path.stat().st_size == source_size and get_source_hash(csv_path) == source_hash
+
+# Rebuilds the raw dataframe (year, country and diagnosis columns) from a snapshot file (or binary file-like object)
+def load_snapshot(snapshot_path):
+    with np.load(snapshot_path, allow_pickle=False) as snapshot:
+        values = snapshot["values"].astype(np.float64)
+        columns = snapshot["columns"].tolist()
+        countries = snapshot["countries"][snapshot["country_codes"]]
+        years = snapshot["years"].astype(np.int64)
+
+    df = pd.DataFrame(values, columns=columns)
+    df.insert(0, entity_column, countries)
+    df.insert(0, "year", years)
+    return df
+
+# Usage: python app_snapshot.py [csv_path]
+if __name__ == "__main__":
+    import sys
+
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else Path(__file__).parent / "OCED_simplified.csv"
+    print(f"Snapshot written to {build_snapshot(csv_path)}")
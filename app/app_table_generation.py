@@ -1,133 +1,189 @@
 # Python modules
 import pandas as pd
-import numpy as np
+import threading
+from html import escape
 
 # From local files
-from app_data_processing import data_processing, get_columns_from_categories
+from app_data_processing import data_processing, get_columns_from_categories, get_base_matrix
 import app_data_processing
-from app_variables import diagnoses_categories_map_aggregates
-
-styled_table_cached = None
-
-# Builds a dataframe with classes names to apply to each "td" table cell element
-def get_table_cell_classes(df, aggregate_index_names):
-    classes = df.transform(lambda row: 
-                           ["summary-row"]*len(row) 
-                           if row.name in aggregate_index_names 
-                           else ["normal-row"]*len(row), 
-                           axis=1)
-    return pd.DataFrame(classes, index=df.index, columns=df.columns)
-
-# Created a styled table from raw data with default styling
+from app_variables import diagnoses_categories_map_aggregates, entity_column, client_side_table, client_side_table_max_entities
+from app_instrumentation import span
+
+# HTML fragments of the full table - shared by every session, so they are only built once and never modified.
+# Built again if columns were added to the base matrix since (the summary columns loaded later by the exported site)
+table_fragments_cached = None
+table_fragments_lock = threading.Lock()
+
+# Id of the <table> element - all CSS rules are scoped to it
+table_id = "T_diagnoses"
+
+# General styling to the whole table (replaces the pandas Styler table styles, set_sticky and summary row styles)
+table_css = f"""
+#{table_id} thead {{ border-bottom: 2px solid black; text-align: center; }}
+#{table_id} td {{ width: 200px; text-align: center; }}
+#{table_id} table {{ border-spacing: 5px; }}
+#{table_id} th {{ padding: 6px; }}
+#{table_id} thead tr:nth-child(1) th {{ position: sticky; background-color: inherit; top: 0px; z-index: 2; }}
+#{table_id} tr:hover td.summary-row, #{table_id} tr:hover th.summary-row {{ background-color: #d9fff6 !important; cursor: pointer; }}
+#{table_id} tr td.summary-row, #{table_id} th.summary-row {{ background-color: #78f4ff; }}
+#{table_id} td.summary-row {{ border-bottom: 1px solid grey; }}
+#{table_id} th.summary-row {{ border-bottom: 1px solid grey; min_width: 150px; width: 250px; }}
+#{table_id} tr:hover td.normal-row, #{table_id} tr:hover th.normal-row {{ background-color: #dbdbdb !important; }}
+"""
+
+# Formats a table value with 1 decimal place and thousands separator
+def format_value(value):
+    if pd.isna(value):
+        return ""
+    return f"{value:,.1f}"
+
+# Renders every header, row heading and cell of the full table (all countries x all diagnosis rows) to HTML once.
+# Rows and columns are numbered by their position in the full table - the row number is used by table_interactivity.js
 def initialise_table(df):
-    oecd_df = df.copy()
-
-    # Process the data - keeping summary columns. 
-    # No need for scaling
-    countries, numeric_data = data_processing(oecd_df, 
-                                              scaling=False, 
+    # Process the data - keeping summary columns.
+    # No need for scaling. Slices the base matrix already built for the plot
+    countries, numeric_data = data_processing(df,
+                                              scaling=False,
                                               include_category_summary=True,
-                                              ) 
+                                              )
 
     # Re-shape the table and indexes
-    table = pd.concat([countries,numeric_data], axis=1)    
-    table = table.set_index('country')
+    table = pd.concat([countries,numeric_data], axis=1)
+    table = table.set_index(entity_column)
     table.index.name = None
-    table = table.T    
+    table = table.T
 
-    # List of names which are the summary/aggregate columns 
+    # List of names which are the summary/aggregate columns
     aggregate_index_names = list(diagnoses_categories_map_aggregates.values())+\
-        ["Diseases of the ear and mastoid process_Per 100 000 population", 
+        ["Diseases of the ear and mastoid process_Per 100 000 population",
          "Congenital malformations, deformations and chromosomal abnormalities_Per 100 000 population"]
 
-    # General styling to the whole table
-    styles_table = [
-        {'selector': 'thead', 'props': 'border-bottom: 2px solid black; text-align: center'},
-        {'selector': 'td', 'props': 'width: 200px'},
-        {'selector': 'table', 'props': 'border-spacing: 5px;'},
-        {'selector': 'th', 'props': 'padding: 6px'},
-        {'selector': 'td', 'props': 'text-align: center'},
-    ]
-
-    # Row specific styling, adding hover styles
-    summary_row_styles = [{'selector': 'tr:hover td', 'props': 'background-color: #d9fff6 !important; cursor: pointer'},
-                    {'selector': 'tr:hover th', 'props': 'background-color: #d9fff6 !important; cursor: pointer;'},
-                    {'selector': 'tr td', 'props': 'background-color: #78f4ff;'},
-                    {'selector': 'td','props': 'border-bottom: 1px solid grey;'},
-                    {'selector': 'th','props': 'border-bottom: 1px solid grey; min_width: 150px; width: 250px'}]
-
-    other_row_styles = [{'selector': 'tr:hover td', 'props': 'background-color: #dbdbdb !important;'},
-                    {'selector': 'tr:hover th', 'props': 'background-color: #dbdbdb !important;'},
-                    ]
-
-    styles_rows = {
-        row_name : summary_row_styles
-            if row_name in aggregate_index_names else
-            other_row_styles            
-        for row_name in table.index
+    row_names = list(table.index)
+    column_names = list(table.columns)
+
+    # Summary rows are clickable to collapse the rows below them (see table_interactivity.js)
+    row_classes = ["summary-row" if row_name in aggregate_index_names else "normal-row" for row_name in row_names]
+
+    column_headings = [f'<th id="{table_id}_level0_col{col}" class="col_heading level0 col{col}" >{escape(country)}</th>'
+                       for col, country in enumerate(column_names)]
+
+    row_headings = [f'<th id="{table_id}_level0_row{row}" class="row_heading level0 row{row} {row_classes[row]}" >'
+                    f'{escape(row_name.replace("_", " "))}</th>'
+                    for row, row_name in enumerate(row_names)]
+
+    cells = [[f'<td id="{table_id}_row{row}_col{col}" class="data row{row} col{col} {row_classes[row]}" >{format_value(value)}</td>'
+              for col, value in enumerate(row_values)]
+             for row, row_values in enumerate(table.to_numpy())]
+
+    return {
+        "base_columns": len(get_base_matrix(df)["columns"]),
+        "row_index": {row_name: row for row, row_name in enumerate(row_names)},
+        "column_index": {country: col for col, country in enumerate(column_names)},
+        "column_headings": column_headings,
+        "row_headings": row_headings,
+        "cells": cells,
     }
 
-    # Apply styling
-    styled = table.style\
-        .format(precision=1, thousands=",", decimal=".")\
-        .format_index(lambda index_name: index_name.replace("_"," "))\
-        .set_table_styles(styles_table)\
-        .set_table_styles(styles_rows, axis=1, overwrite=False)\
-        .apply_index(lambda names: np.where(names.isin(aggregate_index_names), "background-color: #78f4ff;", ""))\
-        .set_sticky(axis = 1)\
-        .set_td_classes(get_table_cell_classes(table, aggregate_index_names))\
-        .set_table_attributes("class='interactive-table'") # Allows JavaScript selection
+# Returns the shared table fragments, building them on first use
+def get_table_fragments(df):
+    global table_fragments_cached
+
+    with table_fragments_lock:
+        if table_fragments_cached is None or table_fragments_cached["base_columns"] != len(get_base_matrix(df)["columns"]):
+            with span("table.fragments"):
+                table_fragments_cached = initialise_table(df)
 
-    return styled
+        return table_fragments_cached
 
+# Builds the table HTML for the selected categories and countries by joining the precomputed fragments
 def create_table(categories, countries_selected, country_to_color, rows_hidden_state):
-    global styled_table_cached 
-    
     data_df_cached = app_data_processing.data_df_cached
 
     # If data not available or no countries/categories selected, don't do anything
     if data_df_cached is None or len(categories)==0 or len(countries_selected)==0:
         return
 
-    styled = styled_table_cached
-
     # For the display table, only need to process the underlying data once
-    # Because the underlying numbers do not change only what to show (i.e. the style)
-    if styled is None:
-        styled = initialise_table(data_df_cached)
-        styled_table_cached = styled # update the cached table
-
-    # Update the styled table depending on country and category selections:
-    # Update header colors
-    styles_columns = {
-            country: [{'selector': '.col_heading',
-                       'props': f'background: linear-gradient(0deg,{country_to_color[country]} 0%, rgba(255,255,255,1) 30%)'}]
-            for country in countries_selected
-        }
-
-    # Hide columns and rows depending on selection
-    all_cols = list(styled.columns)
-    all_rows = list(styled.index)
-    cols_to_hide = [col for col in all_cols if col not in countries_selected]
-    rows_to_hide = [row 
-                    for row in all_rows
-                    if row not in get_columns_from_categories(categories,include_category_summary=True)
-                   ]
-
-    # The state of which row is collapsed is saved in a hidden ui checkbox component. 
+    # Because the underlying numbers do not change only what to show
+    fragments = get_table_fragments(data_df_cached)
+
+    # Columns and rows to show depending on selection, in the order of the full table
+    cols_to_show = sorted(fragments["column_index"][country]
+                          for country in countries_selected
+                          if country in fragments["column_index"])
+    rows_to_show = sorted(fragments["row_index"][row_name]
+                          for row_name in set(get_columns_from_categories(categories, include_category_summary=True))
+                          if row_name in fragments["row_index"])
+
+    # Header colors
+    selection_css = [f'#{table_id} .col_heading.col{fragments["column_index"][country]} '
+                     f'{{ background: linear-gradient(0deg,{country_to_color[country]} 0%, rgba(255,255,255,1) 30%); }}'
+                     for country in countries_selected
+                     if country in fragments["column_index"] and country in country_to_color]
+
+    # The state of which row is collapsed is saved in a hidden ui checkbox component.
     # Sets display of the table cell (<td> or <th>) of the relevant row (<tr>)
     # Note: "display: none" on tr fails
-    rows_to_collapse = {
-        all_rows[int(index)] : [{'selector': 'tr td', 'props': 'display: none'},
-                                {'selector': 'tr th', 'props': 'display: none'}]
-        for index in rows_hidden_state
-    }
+    selection_css += [f'#{table_id} tr td.row{int(index)}, #{table_id} tr th.row{int(index)} {{ display: none; }}'
+                      for index in rows_hidden_state]
+
+    with span("table.render"):
+        return build_table_html(fragments, cols_to_show, rows_to_show, selection_css)
+
+# Joins the fragments of the given columns and rows into the table HTML
+def build_table_html(fragments, cols_to_show, rows_to_show, selection_css=[]):
+    header = "".join(fragments["column_headings"][col] for col in cols_to_show)
+    body = "".join("<tr>" + fragments["row_headings"][row] + "".join(fragments["cells"][row][col] for col in cols_to_show) + "</tr>"
+                   for row in rows_to_show)
+
+    return (f'<style type="text/css">{table_css}{"".join(selection_css)}</style>'
+            f'<table id="{table_id}" class="interactive-table">'
+            f'<thead><tr><th class="blank level0" >&nbsp;</th>{header}</tr></thead>'
+            f'<tbody>{body}</tbody></table>')
+
+# True if the table is sent to the browser in full (client-side table mode, see create_full_table). The full table grows
+# with the number of entities, so above client_side_table_max_entities only the selection is rendered (see create_table)
+def is_client_side_table():
+    data_df_cached = app_data_processing.data_df_cached
 
-    # Apply/update styling in response to reactive inputs.
-    styled\
-        .hide(cols_to_hide, axis = 1)\
-        .hide(rows_to_hide, axis = 0)\
-        .set_table_styles(styles_columns, overwrite=False)\
-        .set_table_styles(rows_to_collapse, axis =1, overwrite=False)\
+    if not client_side_table or data_df_cached is None:
+        return client_side_table
+    return len(get_base_matrix(data_df_cached)["countries"]) <= client_side_table_max_entities
 
-    return styled
+# Client-side table mode: the full table (every country and row) is sent to the browser once,
+# then only the visibility payload from get_table_visibility is sent on each selection change
+def create_full_table():
+    data_df_cached = app_data_processing.data_df_cached
+
+    if data_df_cached is None:
+        return
+
+    fragments = get_table_fragments(data_df_cached)
+
+    return build_table_html(fragments,
+                            cols_to_show=range(len(fragments["column_index"])),
+                            rows_to_show=range(len(fragments["row_index"])))
+
+# Visibility payload applied in the browser by table_interactivity.js (client-side table mode).
+# Columns and rows are the numbers used in the "colN"/"rowN" classes of the full table
+def get_table_visibility(categories, countries_selected, country_to_color):
+    data_df_cached = app_data_processing.data_df_cached
+
+    if data_df_cached is None:
+        return
+
+    fragments = get_table_fragments(data_df_cached)
+
+    visible_rows = set(get_columns_from_categories(categories, include_category_summary=True))
+    countries_selected = set(countries_selected)
+
+    return {
+        "table_id": table_id,
+        # Same as create_table returning nothing
+        "visible": len(categories)>0 and len(countries_selected)>0,
+        "hidden_columns": [col for country, col in fragments["column_index"].items() if country not in countries_selected],
+        "hidden_rows": [row for row_name, row in fragments["row_index"].items() if row_name not in visible_rows],
+        "header_colors": {col: country_to_color[country] 
+                          for country, col in fragments["column_index"].items() 
+                          if country in countries_selected and country in country_to_color},
+    }
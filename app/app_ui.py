@@ -3,7 +3,8 @@ from shiny import ui
 from shinywidgets import output_widget
 
 # From local files
-from app_variables import diagnoses_categories_map
+from app_variables import diagnoses_categories_map, data_year, data_first_year, year_animation_interval
+from app_instrumentation import profiling_enabled
 
 # Split the list of categories in two for UI purposes
 categories = list(diagnoses_categories_map.keys())
@@ -88,6 +89,14 @@ app_ui = ui.page_fluid(
             ),
             class_="d-flex justify-content-center text-center",
         ),
+        # Year slider - the play button animates the plot through the years
+        ui.div(
+            ui.input_slider(
+                "year", "Year", min=data_first_year, max=data_year, value=data_year, step=1, sep="",
+                animate=ui.AnimationOptions(interval=year_animation_interval, loop=False),
+            ),
+            class_="d-flex justify-content-center text-center",
+        ),
         # Toggle category selector panel button
         ui.div(
             ui.panel_conditional(
@@ -110,7 +119,7 @@ app_ui = ui.page_fluid(
             ),
             class_="d-flex justify-content-center mb-1",
         ),
-        # Label toggle and clear country selection buttons
+        # Label and zoom toggles and clear country selection buttons
         ui.div(
             ui.input_action_button(
                 "toggle_labels_button",
@@ -118,6 +127,12 @@ app_ui = ui.page_fluid(
                 class_="btn-primary ",
                 width="200px",
             ),
+            ui.input_action_button(
+                "toggle_zoom_button",
+                "Toggle Zoom",
+                class_="btn-outline-primary ms-1",
+                width="150px",
+            ),
             ui.input_action_button(
                 "clear_country_selection_button",
                 "Clear Selected Countries",
@@ -145,7 +160,7 @@ app_ui = ui.page_fluid(
     
     # Output table
     ui.div(
-        ui.output_table("table_output"),
+        ui.output_ui("table_output"),
         class_="d-flex justify-content-center"
     ),
 
@@ -165,6 +180,13 @@ app_ui = ui.page_fluid(
         {"style": "display: none"},
     ),
 
+    # Debug panel (collapsed) with profiling timings - only included when profiling is enabled, see app_instrumentation.py
+    ui.tags.details(
+        ui.tags.summary("Profiling"),
+        ui.output_text_verbatim("profiling_output"),
+        {"style": "margin: 10px 20px; color: grey"},
+    ) if profiling_enabled else None,
+
     # Footer
     ui.tags.footer(
         ui.div(
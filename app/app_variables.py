@@ -1,5 +1,39 @@
+# Python modules
+import os
+import sys
+from pathlib import Path
+
 # Variables 
-data_url = "https://raw.githubusercontent.com/drpawelo/python-advanced-HSC/main/week_05/starting_code/OCED_simplified.csv"
+running_in_pyodide = sys.platform == "emscripten" # True when running in the browser (Shinylive), False on a Shiny server
+data_manifest_filename = "data_manifest.json" # Data assets of the exported site, written next to app.py by app_export.py
+# "local" (data_filename), "web" (data_url, fetched through app_fetch.py) or "assets" (the data assets of the exported site,
+# the default when the app was exported with app_export.py)
+data_source = os.environ.get("APP_DATA_SOURCE", "assets" if (Path(__file__).parent / data_manifest_filename).exists() else "local")
+data_assets_url = os.environ.get("APP_DATA_ASSETS_URL") # Root URL of the exported site - None in the browser uses the site the app was loaded from
+data_url = os.environ.get("APP_DATA_URL", "https://raw.githubusercontent.com/drpawelo/python-advanced-HSC/main/week_05/starting_code/OCED_simplified.csv")
+data_filename = "OCED_simplified.csv" # Local copy of the data at data_url, next to app.py
+data_cache_dir = os.environ.get("APP_DATA_CACHE_DIR", str(Path.home() / ".cache" / "country_diagnosis_visualisation")) # Persistent cache of fetched data (IndexedDB in the browser)
+data_cache_max_age = 3600 # Seconds a cached copy of data_url is used without asking the server whether it changed
+fetch_timeout = 30 # Seconds without response before a fetch of data_url is retried
+fetch_retries = 3 # Retries of a failed fetch of data_url, with exponential backoff
+# Persistent cache of the base matrix and fitted layouts (app_disk_cache.py), so a restarted server process starts warm.
+# On by default on a server, off in the browser. Entries are keyed by a hash of the data, settings, model code and library versions
+disk_cache_enabled = os.environ.get("APP_DISK_CACHE", "0" if running_in_pyodide else "1") not in ("", "0", "false", "False")
+disk_cache_dir = os.environ.get("APP_DISK_CACHE_DIR", str(Path(data_cache_dir) / "processed"))
+disk_cache_max_datasets = 4 # Entries of other datasets (or settings/versions) kept, older ones are deleted
+data_encoding = "latin-1" # Encoding of OCED_simplified.csv (e.g. "Türkiye")
+client_side_table = True # Send the full table to the browser once and only update which countries/rows are shown
+client_side_table_max_entities = 100 # Above this number of entities the table is rendered on the server for the selection (the full table is about 13 KB per entity)
+input_debounce_delay = 0.3 # Seconds - category/cluster input changes closer together than this are coalesced into one plot update
+entity_column = "country" # Column naming the entities compared (points of the plot, columns of the table), e.g. "region" for sub-national data
+data_year = 2021 # Year shown by default - missing values are filled with the latest earlier value of the same entity
+data_first_year = 2010 # First year of the year slider. Layouts of the other years are fitted for all years at once
+year_animation_interval = 2500 # Milliseconds between years when the year slider is played
+# Entities dropped because many metrics are missing - list derived from Pandas exploration not shown here
+to_drop_entities = ["United Kingdom","China (People's Republic of)","Estonia","India",
+                    "Indonesia","Russia","South Africa","Brazil","Colombia"]
+exact_layout_max_points = 500 # Above this number of entities layouts are fitted with the scalable approximate methods of app_numeric.py
+model_backend = "numpy" # "numpy" (app_numeric.py, no scikit-learn needed) or "sklearn" (reference implementation) for imputation, scaling, embedding and clustering
 
 # Dictionary to map categories of diagnoses to columns
 diagnoses_categories_map = {
@@ -81,7 +81,7 @@ function toggle_show_hide_rows(row) {
 // Adds onclick function to each summary row
 function make_table_clickable(table) {
     // Use "has" CSS pseudo-class to select the table row (tr) that contains a cell (td) with class "summary-row"
-    // Table cells (td) were classed during table styling in app_data_processing.py
+    // Table cells (td) were classed when building the table fragments in app_table_generation.py
     const summary_rows = table.querySelectorAll("tr:has(td.summary-row)"); // List of <tr> elements to be made clickable
 
     // Add onclick for each row
@@ -93,7 +93,7 @@ function make_table_clickable(table) {
 
 // Observes the table div for reactive changes. If table exists, make its summary rows clickable
 async function observe_table() {    
-    // Retrieve the <div> corresponding to the shiny ui element: ui.output_table("table_output"). 
+    // Retrieve the <div> corresponding to the shiny ui element: ui.output_ui("table_output"). 
     // This is not available on page start - so need to listen for it using wait_for_element
     const target_node = await wait_for_element("#table_output"); 
 
@@ -101,7 +101,7 @@ async function observe_table() {
     const callback = (mutationList, observer) => {
       for (const mutation of mutationList) {
         if (mutation.type === "childList") {
-            table_element = target_node.querySelector('.interactive-table'); // "interactive-table" class was added during table styling in app_data_processing.py
+            table_element = target_node.querySelector('.interactive-table'); // "interactive-table" class was added when building the table in app_table_generation.py
             
             if (table_element) {
                 make_table_clickable(table_element);
@@ -118,3 +118,32 @@ async function observe_table() {
 };
 
 observe_table();
+
+// Client-side table mode (client_side_table in app_variables.py): the full table is rendered once and the server only
+// sends which countries (columns) and diagnosis rows to show, and the header colors of the selected countries.
+// These are applied as CSS rules in a dedicated <style> element, so the table itself is never replaced.
+// "!important" so that hidden rows stay hidden even if a cell's inline display was set by toggle_show_hide_rows
+function apply_table_visibility(visibility) {
+    let style_element = document.getElementById("table_visibility_style");
+    if (!style_element) {
+        style_element = document.createElement("style");
+        style_element.id = "table_visibility_style";
+        document.head.appendChild(style_element);
+    };
+
+    const table = `#${visibility.table_id}`;
+    const rules = [];
+
+    if (!visibility.visible) {
+        rules.push(`${table} { display: none; }`);
+    };
+    visibility.hidden_columns.forEach(col => rules.push(`${table} .col${col} { display: none !important; }`));
+    visibility.hidden_rows.forEach(row => rules.push(`${table} .row${row} { display: none !important; }`));
+    Object.entries(visibility.header_colors).forEach(([col, color]) => {
+        rules.push(`${table} .col_heading.col${col} { background: linear-gradient(0deg,${color} 0%, rgba(255,255,255,1) 30%); }`);
+    });
+
+    style_element.textContent = rules.join("\n");
+};
+
+Shiny.addCustomMessageHandler("table_visibility", apply_table_visibility);
@@ -0,0 +1,443 @@
+# Headless benchmark of the data -> embedding -> figure -> table pipeline (no browser or Shiny session needed).
+#
+# Times each stage over realistic interaction traces and reports percentiles (ms) and peak memory (MB) as JSON,
+# which can be diffed between versions with --compare.
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_pipeline.py                                   # bundled dataset
+#   python benchmarks/bench_pipeline.py --scale 1 4 16 --output new.json  # also synthetically enlarged datasets
+#   python benchmarks/bench_pipeline.py --compare old.json new.json       # ratio of p50 timings new/old
+#   python benchmarks/bench_pipeline.py --scaling-curve 100 1000 10000    # also layout fit time against number of entities
+#   python benchmarks/bench_pipeline.py --parity 300                      # check the NumPy backend against scikit-learn
+#
+# The remote data fetch is timed against a local stand-in for the data host (serve_data.py)
+#
+# The start up cost ("import app" in a fresh interpreter) is checked against --import-budget-ms: the benchmark exits
+# with an error if it is over budget or if the modelling modules (scikit-learn) are imported at start up
+
+# Python modules
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+app_dir = Path(__file__).resolve().parent.parent / "app"
+sys.path.insert(0, str(app_dir))
+os.environ.setdefault("APP_DISK_CACHE", "0") # Stages time the processing and fits, not the disk cache (except the restart stages)
+
+# From local files
+import app_data_processing
+import app_plotting
+import app_table_generation
+import app_disk_cache
+from app_data_processing import model_modules, process_latest_values, get_training_matrix, get_local_data, get_base_matrix, get_layout, fit_plot_layout, update_plot_layout, train_and_get_plot
+from app_plotting import fit_layout, fit_layout_approximate, fit_embedding, fit_clusters, plot_highlight_circle, get_country_colors, toggle_selection
+from app_table_generation import create_table, get_table_visibility
+from app_variables import diagnoses_categories_map, data_encoding, model_backend, exact_layout_max_points
+
+bundled_csv = app_dir / "OCED_simplified.csv"
+
+# Measured "import app" is about 1.5 s on a laptop CPython without scikit-learn, about 3 s with it
+default_import_budget_ms = 2500
+categories_all = list(diagnoses_categories_map.keys())
+
+# Clears the process-wide caches so that the next call pays the full cold cost
+def reset_caches():
+    app_data_processing.data_df_cached = None
+    app_data_processing.base_matrix_cached = None
+    app_table_generation.table_fragments_cached = None
+
+# Summary statistics of a list of timings in seconds, reported in milliseconds
+def summarise(timings, peak_memory=None):
+    timings_ms = np.array(timings) * 1000
+    summary = {
+        "n": len(timings_ms),
+        "mean": float(timings_ms.mean()),
+        "p50": float(np.percentile(timings_ms, 50)),
+        "p90": float(np.percentile(timings_ms, 90)),
+        "p99": float(np.percentile(timings_ms, 99)),
+        "max": float(timings_ms.max()),
+    }
+    if peak_memory is not None:
+        summary["peak_memory_mb"] = peak_memory / 1e6
+    return summary
+
+# Runs func() repeats times (setup() before each run, untimed) and returns its summary.
+# Peak memory is measured in one extra run with tracemalloc, so it does not slow down the timed runs
+def time_stage(func, repeats, setup=None):
+    timings = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return summarise(timings, peak_memory)
+
+# Writes a csv with the same structure as the bundled one, where every country is copied scale times with noise
+def make_synthetic_csv(scale, directory, seed=0):
+    if scale == 1:
+        return bundled_csv
+
+    rng = np.random.default_rng(seed)
+    df = pd.read_csv(bundled_csv, encoding=data_encoding)
+    numeric_columns = [column for column in df.columns if column not in ("year", "country")]
+
+    copies = []
+    for copy_number in range(scale):
+        df_copy = df.copy()
+        if copy_number > 0:
+            df_copy["country"] = df_copy["country"] + f" ({copy_number})"
+            df_copy[numeric_columns] = df_copy[numeric_columns] * rng.lognormal(0, 0.1, size=(len(df), len(numeric_columns)))
+        copies.append(df_copy)
+
+    outfile = Path(directory) / f"synthetic_x{scale}.csv"
+    pd.concat(copies).to_csv(outfile, index=False, encoding=data_encoding)
+    return outfile
+
+# A reproducible interaction trace like a real session: category toggles (often returning to earlier selections),
+# cluster slider moves and country clicks
+def make_trace(countries, length=60, seed=0):
+    rng = random.Random(seed)
+    selected = set(categories_all)
+    trace = []
+    for _ in range(length):
+        event = rng.choices(["toggle", "num_groups", "select"], weights=[5, 2, 3])[0]
+        if event == "toggle":
+            selected ^= {rng.choice(categories_all)}
+            if not selected:
+                selected = {rng.choice(categories_all)}
+            trace.append(("toggle", sorted(selected)))
+        elif event == "num_groups":
+            trace.append(("num_groups", rng.randint(1, 7)))
+        else:
+            trace.append(("select", rng.choice(countries)))
+    return trace
+
+# Replays a trace the way app_server.py handles each event, timing each event type
+def run_trace(fig, trace):
+    categories, num_groups, selected = categories_all, 3, {}
+    timings = {"trace_toggle": [], "trace_num_groups": [], "trace_select": []}
+
+    for event, value in trace:
+        start = time.perf_counter()
+        if event == "select":
+            selected = toggle_selection(selected, value)
+            plot_highlight_circle(fig, selected_countries=selected)
+        else:
+            if event == "toggle":
+                categories = value
+            else:
+                num_groups = value
+            update_plot_layout(fig, fit_plot_layout(categories, num_groups), categories, selected)
+
+        country_to_color = get_country_colors(fig)
+        create_table(categories, selected, country_to_color, rows_hidden_state=[])
+        get_table_visibility(categories, selected, country_to_color)
+        timings[f"trace_{event}"].append(time.perf_counter() - start)
+
+    return {name: summarise(values) for name, values in timings.items() if values}
+
+# Matrix of n_entities synthetic entities (e.g. regions) like the scaled base matrix: each row lies between two random
+# countries, with noise, so the synthetic entities form a connected cloud rather than copies of the countries
+def make_synthetic_entities(base, n_entities, seed=0):
+    rng = np.random.default_rng(seed)
+    scaled = base["scaled"]
+    first, second = rng.integers(0, len(scaled), n_entities), rng.integers(0, len(scaled), n_entities)
+    weights = rng.random((n_entities, 1))
+    return weights * scaled[first] + (1 - weights) * scaled[second] + rng.normal(0, 0.1, (n_entities, scaled.shape[1]))
+
+# Layout fit time against the number of entities for the exact and the approximate (scalable) methods.
+# The exact methods are only timed up to exact_max_entities as they grow with the square/cube of the number of entities
+def benchmark_scaling(sizes, repeats, seed, exact_max_entities=2000):
+    base = get_base_matrix(get_local_data(bundled_csv))
+    curve = []
+
+    for n_entities in sizes:
+        X = make_synthetic_entities(base, n_entities, seed)
+        point = {"entities": n_entities, "backend": "exact" if n_entities <= exact_layout_max_points else "approximate"}
+        if n_entities <= exact_max_entities:
+            point["exact"] = time_stage(lambda: fit_layout(X), repeats)
+        point["approximate"] = time_stage(lambda: fit_layout_approximate(X), repeats)
+        curve.append(point)
+        print(f"Finished scaling {n_entities}", file=sys.stderr)
+
+    return curve
+
+def benchmark_dataset(csv_path, repeats, seed):
+    results = {}
+    subsets = [random.Random(seed + index).sample(categories_all, random.Random(seed - index).randint(1, len(categories_all)))
+               for index in range(repeats)]
+
+    # Cold load of the raw data (snapshot if present, otherwise csv)
+    results["cold_load"] = time_stage(lambda: get_local_data(csv_path), repeats, setup=reset_caches)
+    df = get_local_data(csv_path)
+
+    # Category independent processing (ffill, filter, impute, scale)
+    results["base_processing"] = time_stage(lambda: app_data_processing.build_base_matrix(df), repeats)
+    base = get_base_matrix(df)
+    countries = list(base["countries"]["country"])
+
+    # Restart of a server process - base matrix and the layout of a selection built and stored in an empty disk cache,
+    # then loaded from it
+    with tempfile.TemporaryDirectory() as cache_dir:
+        app_disk_cache.disk_cache_enabled, app_disk_cache.disk_cache_dir = True, cache_dir
+        restart = lambda: get_layout(df, subsets[0], 3)
+        try:
+            results["restart_disk_cache_cold"] = time_stage(restart, repeats, setup=lambda: (
+                setattr(app_data_processing, "base_matrix_cached", None), shutil.rmtree(cache_dir), Path(cache_dir).mkdir()))
+            results["restart_disk_cache_warm"] = time_stage(restart, repeats,
+                                                            setup=lambda: setattr(app_data_processing, "base_matrix_cached", None))
+        finally:
+            app_disk_cache.disk_cache_enabled = False
+            app_data_processing.base_matrix_cached = None
+    base = get_base_matrix(df)
+
+    # Refit for a new category subset - embedding and clustering, no cache (as get_layout on a cache miss).
+    # Exact or approximate methods depending on the number of entities
+    subset_iterator = iter(subsets * 2)
+    results["subset_refit"] = time_stage(lambda: app_data_processing.fit_category_layout(df, next(subset_iterator)), repeats)
+
+    # First layout of a selection in a fresh layout cache - looked up if in the precomputed layouts file (app_layouts.py)
+    selection_iterator = iter([[category] for category in categories_all] * (repeats + 1))
+    results["first_layout"] = time_stage(lambda: get_layout(df, next(selection_iterator), 3), repeats, setup=base["layouts"].clear)
+    results["precomputed_layouts"] = len(base["precomputed_layouts"]["index"]) if base["precomputed_layouts"] else 0
+
+    # Sweep of the cluster slider over a cached embedding
+    get_layout(df, categories_all, 3)
+    results["num_groups_sweep"] = time_stage(lambda: [get_layout(df, categories_all, num_groups) for num_groups in range(1, 8)], repeats)
+
+    # Multi-year mode - layouts of every year fitted in one batch for a new selection, then a sweep of the year slider
+    subset_iterator = iter(subsets * 2)
+    results["year_layouts"] = time_stage(lambda: app_data_processing.get_year_layouts(df, next(subset_iterator)), repeats,
+                                         setup=base["year_layouts"].clear)
+    years = [int(year) for year in app_data_processing.get_year_matrices(df)["years"]]
+    results["year_sweep"] = time_stage(lambda: [get_layout(df, categories_all, 3, year) for year in years], repeats)
+
+    # Initial figure, highlight toggling and table generation
+    fig = asyncio.run(train_and_get_plot(categories_all, 3))
+    selections = [random.Random(seed + index).sample(countries, min(5, len(countries))) for index in range(repeats + 1)]
+    selection_iterator = iter(selections * 2)
+    results["plot_highlight_circle"] = time_stage(lambda: plot_highlight_circle(fig, next(selection_iterator)), repeats)
+
+    country_to_color = get_country_colors(fig)
+    selection_iterator = iter(selections * 2)
+    results["create_table_cold"] = time_stage(lambda: create_table(categories_all, countries[:5], country_to_color, []),
+                                              repeats, setup=lambda: setattr(app_table_generation, "table_fragments_cached", None))
+    results["create_table"] = time_stage(lambda: create_table(categories_all, next(selection_iterator), country_to_color, []), repeats)
+
+    # Realistic interaction trace (warm caches as in a real session)
+    base["layouts"].clear()
+    results.update(run_trace(fig, make_trace(countries, seed=seed)))
+    results["layout_cache"] = base["layouts"].info()
+
+    results["num_countries"] = len(countries)
+    return results
+
+# Remote data fetch (app_fetch.py) from a local stand-in for the data host: cold download, revalidation (304 Not Modified),
+# fresh cached copy and a download interrupted half way and resumed
+def benchmark_fetch(csv_path, repeats):
+    from app_fetch import fetch_and_parse
+    from app_data_processing import read_csv_projected, get_columns_projection
+    from serve_data import start_server, get_url
+    import app_fetch
+
+    columns = get_columns_projection()
+    parse = lambda stream: read_csv_projected(stream, columns)
+    size = Path(csv_path).stat().st_size
+    server = start_server(csv_path, drops=repeats + 1, drop_after=size // 8)
+    url = get_url(server)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        clear_cache = lambda: [path.unlink() for path in Path(cache_dir).iterdir()]
+        max_age = app_fetch.data_cache_max_age
+        try:
+            results["fetch_resumed"] = time_stage(lambda: fetch_and_parse(url, parse, cache_dir), repeats, setup=clear_cache)
+            results["fetch_cold"] = time_stage(lambda: fetch_and_parse(url, parse, cache_dir), repeats, setup=clear_cache)
+            results["fetch_fresh"] = time_stage(lambda: fetch_and_parse(url, parse, cache_dir), repeats)
+            app_fetch.data_cache_max_age = 0
+            results["fetch_revalidated"] = time_stage(lambda: fetch_and_parse(url, parse, cache_dir), repeats)
+        finally:
+            app_fetch.data_cache_max_age = max_age
+            server.shutdown()
+            server.server_close()
+
+    results["fetch_requests"] = len(server.requests)
+    return results
+
+# Times "import app" (the Shiny app start up before the UI can be served) and the deferred modelling imports,
+# each in a fresh interpreter so nothing is already imported
+def time_app_import(repeats):
+    script = ("import sys, time; start = time.perf_counter(); import app; app_ms = (time.perf_counter() - start) * 1000; "
+              "eager = sorted(module for module in sys.modules if module.split('.')[0] in ('sklearn', 'scipy')); "
+              "start = time.perf_counter(); import app_data_processing; app_data_processing.preload_model_modules(); "
+              "print(app_ms, (time.perf_counter() - start) * 1000, len(eager))")
+
+    app_timings, model_timings, eager_modules = [], [], 0
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", script], cwd=app_dir, check=True, capture_output=True, text=True).stdout
+        app_ms, model_ms, eager_modules = output.split()[-3:]
+        app_timings.append(float(app_ms) / 1000)
+        model_timings.append(float(model_ms) / 1000)
+
+    return {
+        "import_app": summarise(app_timings),
+        "import_model_modules": {**summarise(model_timings), "modules": model_modules},
+        "eager_model_modules": int(eager_modules),
+    }
+
+def get_versions():
+    import bqplot
+    versions = {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                "bqplot": bqplot.__version__, "model_backend": model_backend}
+
+    # scikit-learn is only needed by the "sklearn" model backend
+    try:
+        import sklearn
+        versions["sklearn"] = sklearn.__version__
+    except ImportError:
+        pass
+
+    return versions
+
+# Runs func with the given model backend ("numpy" or "sklearn") in the modules that branch on it
+def run_with_backend(backend, func, *args):
+    previous = app_data_processing.model_backend, app_plotting.model_backend
+    app_data_processing.model_backend = app_plotting.model_backend = backend
+    try:
+        return func(*args)
+    finally:
+        app_data_processing.model_backend, app_plotting.model_backend = previous
+
+# True if two label arrays are the same partition, i.e. equal up to a renumbering of the clusters
+def same_partition(labels, other_labels):
+    pairs = set(zip(labels.tolist(), other_labels.tolist()))
+    return len(pairs) == len(set(labels.tolist())) == len(set(other_labels.tolist()))
+
+# Checks the NumPy backend against the scikit-learn reference on the bundled data: imputation and scaling of the base
+# matrix, then fit_embedding and fit_clusters for all categories, every single category and n_subsets random selections.
+# Embeddings must match within tolerance up to the sign of each axis (eigenvectors have no sign) and the labels of every
+# number of clusters must give the same partition. Returns the largest differences and the selections that did not match
+def check_backend_parity(n_subsets, seed, tolerance=1e-8):
+    df = get_local_data(bundled_csv)
+    report = {"subsets": 0, "base_max_diff": 0.0, "embedding_max_diff": 0.0, "mismatches": []}
+
+    # Imputed and scaled latest values (the base matrix before the distances)
+    base = {backend: run_with_backend(backend, process_latest_values, df) for backend in ["numpy", "sklearn"]}
+    if base["numpy"][1] != base["sklearn"][1]:
+        report["mismatches"].append({"stage": "imputed_columns"})
+    else:
+        report["base_max_diff"] = max(float(np.abs(base["numpy"][index] - base["sklearn"][index]).max()) for index in [2, 3])
+    if report["base_max_diff"] > tolerance:
+        report["mismatches"].append({"stage": "impute_and_scale", "max_diff": report["base_max_diff"]})
+
+    subsets = ([categories_all] + [[category] for category in categories_all] +
+               [random.Random(seed + index).sample(categories_all, random.Random(seed - index).randint(1, len(categories_all)))
+                for index in range(n_subsets)])
+    for subset in subsets:
+        _, _, X_train = get_training_matrix(df, subset, scaling=True)
+        embeddings = {backend: run_with_backend(backend, fit_embedding, X_train) for backend in ["numpy", "sklearn"]}
+        signs = np.sign(np.sum(embeddings["numpy"] * embeddings["sklearn"], axis=0))
+        embedding_diff = float(np.abs(embeddings["numpy"] * signs - embeddings["sklearn"]).max())
+        report["embedding_max_diff"] = max(report["embedding_max_diff"], embedding_diff)
+
+        labels = {backend: run_with_backend(backend, fit_clusters, embeddings[backend]) for backend in ["numpy", "sklearn"]}
+        num_groups_mismatched = [num_groups + 1 for num_groups in range(len(labels["sklearn"]))
+                                 if not same_partition(labels["numpy"][num_groups], labels["sklearn"][num_groups])]
+
+        if embedding_diff > tolerance or num_groups_mismatched:
+            report["mismatches"].append({"categories": subset, "embedding_diff": embedding_diff, "num_groups": num_groups_mismatched})
+        report["subsets"] += 1
+
+    return report
+
+# Prints the p50 ratio new/old for every stage of every dataset found in both files
+def compare(old_file, new_file):
+    old, new = json.loads(Path(old_file).read_text()), json.loads(Path(new_file).read_text())
+    old_datasets = {**old["datasets"], "imports": old.get("imports", {})}
+    new_datasets = {**new["datasets"], "imports": new.get("imports", {})}
+    for dataset, stages in new_datasets.items():
+        for stage, stats in stages.items():
+            old_stats = old_datasets.get(dataset, {}).get(stage)
+            if isinstance(stats, dict) and "p50" in stats and isinstance(old_stats, dict) and "p50" in old_stats:
+                ratio = stats["p50"] / old_stats["p50"] if old_stats["p50"] else float("inf")
+                print(f"{dataset:>12} {stage:<22} {old_stats['p50']:10.2f} ms -> {stats['p50']:10.2f} ms  x{ratio:.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark of the data -> embedding -> figure -> table pipeline")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1], help="Dataset sizes as multiples of the bundled countries")
+    parser.add_argument("--scaling-curve", type=int, nargs="+", metavar="ENTITIES",
+                        help="Also time exact and approximate layout fits for these numbers of synthetic entities, e.g. 100 1000 10000")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--import-budget-ms", type=float, default=default_import_budget_ms,
+                        help="Maximum p50 time of importing the app (start up before the UI is served)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    parser.add_argument("--parity", type=int, metavar="SUBSETS",
+                        help="Check the NumPy backend against scikit-learn on SUBSETS random category selections and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.parity is not None:
+        report = check_backend_parity(args.parity, args.seed)
+        print(json.dumps(report, indent=2))
+        if report["mismatches"]:
+            sys.exit(f"The NumPy backend does not match scikit-learn for {len(report['mismatches'])} checks")
+        return
+
+    results = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "versions": get_versions()}, "datasets": {}}
+    results["imports"] = time_app_import(min(args.repeats, 5))
+    results["imports"]["budget_ms"] = args.import_budget_ms
+
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in args.scale:
+            reset_caches()
+            csv_path = make_synthetic_csv(scale, directory, seed=args.seed)
+            name = "bundled" if scale == 1 else f"x{scale}"
+            results["datasets"][name] = benchmark_dataset(csv_path, args.repeats, args.seed)
+            results["datasets"][name].update(benchmark_fetch(csv_path, args.repeats))
+            print(f"Finished {name}", file=sys.stderr)
+
+    if args.scaling_curve:
+        reset_caches()
+        results["scaling"] = benchmark_scaling(args.scaling_curve, min(args.repeats, 3), args.seed)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    imports = results["imports"]
+    if imports["eager_model_modules"]:
+        sys.exit("Modelling modules are imported at start up - import them on first use instead")
+    if imports["import_app"]["p50"] > args.import_budget_ms:
+        sys.exit(f"Importing the app took {imports['import_app']['p50']:.0f} ms, over the budget of {args.import_budget_ms:.0f} ms")
+
+if __name__ == "__main__":
+    main()
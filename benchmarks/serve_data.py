@@ -0,0 +1,119 @@
+# Local stand-in for the data host (data_url in app/app_variables.py), to test and benchmark the fetch layer
+# (app/app_fetch.py) without network access. Serves one file with the HTTP features the fetch layer uses:
+#   - strong ETag and Last-Modified validators, answering conditional requests with 304 Not Modified
+#   - gzip content encoding when the client accepts it
+#   - byte ranges (Range and If-Range) of the representation sent, so interrupted downloads can be resumed
+# and can inject faults: server errors (--errors) and connections dropped part way through the body (--drop-after).
+#
+# Usage (from the repository root):
+#   python benchmarks/serve_data.py app/OCED_simplified.csv --port 8000 --drop-after 100000
+#   APP_DATA_SOURCE=web APP_DATA_URL=http://127.0.0.1:8000/OCED_simplified.csv shiny run app/app.py
+
+# Python modules
+import argparse
+import gzip
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Serves the file at /<file name>. Faults are counted over all requests:
+# the first `errors` requests get 503, then the first `drops` full bodies are cut after drop_after bytes
+class DataHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.requests.append(dict(self.headers))
+            inject_error = server.errors > 0
+            server.errors -= inject_error
+
+        if self.path.split("?")[0] != "/" + server.path.name:
+            self.send_error(404)
+            return
+        if inject_error:
+            self.send_error(503)
+            return
+
+        # Conditional request - the client's copy (of either representation) is still current
+        if (self.headers.get("If-None-Match") in (server.etag, server.etag[:-1] + '-gzip"') or
+                (self.headers.get("If-Modified-Since") and "If-None-Match" not in self.headers and
+                 parsedate_to_datetime(self.headers["If-Modified-Since"]).timestamp() >= int(server.mtime))):
+            self.send_response(304)
+            self.send_header("ETag", server.etag)
+            self.end_headers()
+            return
+
+        use_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        body = server.gzip_body if use_gzip else server.body
+        etag = server.etag[:-1] + '-gzip"' if use_gzip else server.etag
+
+        # Range of the representation sent (If-Range: only if the client's partial copy is of the same version)
+        start = 0
+        if self.headers.get("Range", "").startswith("bytes=") and self.headers.get("If-Range", etag) == etag:
+            start = int(self.headers["Range"][len("bytes="):].split("-")[0])
+
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body) - start))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(server.mtime, usegmt=True))
+        self.send_header("Accept-Ranges", "bytes")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+
+        with server.lock:
+            drop = not start and server.drops > 0
+            server.drops -= drop
+
+        if drop:
+            self.wfile.write(body[:server.drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body[start:])
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+# HTTP server for path on a background thread (port 0 picks a free port, see server.server_port)
+def start_server(path, port=0, errors=0, drops=0, drop_after=0, verbose=False):
+    server = ThreadingHTTPServer(("127.0.0.1", port), DataHandler)
+    server.path = Path(path)
+    server.body = server.path.read_bytes()
+    server.gzip_body = gzip.compress(server.body, mtime=0)
+    server.etag = '"' + hashlib.sha1(server.body).hexdigest() + '"'
+    server.mtime = server.path.stat().st_mtime
+    server.errors, server.drops, server.drop_after = errors, drops, drop_after
+    server.requests = []
+    server.lock = threading.Lock()
+    server.verbose = verbose
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# URL of the served file
+def get_url(server):
+    return f"http://127.0.0.1:{server.server_port}/{server.path.name}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the data host")
+    parser.add_argument("path", help="File to serve")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--errors", type=int, default=0, help="Answer the first ERRORS requests with 503")
+    parser.add_argument("--drops", type=int, default=1, help="Number of full bodies cut short when --drop-after is set")
+    parser.add_argument("--drop-after", type=int, default=0, help="Close the connection after this many bytes of the body")
+    args = parser.parse_args()
+
+    server = start_server(args.path, args.port, args.errors, args.drops if args.drop_after else 0, args.drop_after, verbose=True)
+    print(f"Serving {get_url(server)}")
+    threading.Event().wait()
+
+if __name__ == "__main__":
+    main()
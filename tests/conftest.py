@@ -0,0 +1,10 @@
+# The app modules import each other by file name (as in Shinylive), so the app directory is put on the path
+import os
+import sys
+from pathlib import Path
+
+app_dir = Path(__file__).resolve().parent.parent / "app"
+sys.path.insert(0, str(app_dir))
+
+# Tests compare results computed from the data, not ones stored by earlier runs
+os.environ.setdefault("APP_DISK_CACHE", "0")
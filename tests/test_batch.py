@@ -0,0 +1,33 @@
+# From local files
+import app_data_processing
+import app_disk_cache
+from app_batch import compute_layouts
+from app_data_processing import get_base_matrix, get_layout
+from app_variables import diagnoses_categories_map, data_year
+
+subsets = [list(diagnoses_categories_map)[:1], list(diagnoses_categories_map)[1:4]]
+
+def use_batch_cache_settings(monkeypatch):
+    # compute_layouts turns the disk cache on for its workers (in this process with workers=1)
+    monkeypatch.setattr(app_disk_cache, "disk_cache_enabled", app_disk_cache.disk_cache_enabled)
+    monkeypatch.setattr(app_disk_cache, "disk_cache_dir", app_disk_cache.disk_cache_dir)
+
+# A batch of data_year only gives the layouts of the app and does not build the matrices of every year
+def test_batch_of_data_year_skips_year_matrices(monkeypatch):
+    use_batch_cache_settings(monkeypatch)
+    entities, layouts = compute_layouts(subsets, num_groups=[2, 3], workers=1)
+
+    df = app_data_processing.data_df_cached
+    assert get_base_matrix(df)["year_matrices"] is None
+    assert len(layouts) == len(subsets) * 2
+    for layout in layouts:
+        X_reduced, labels = get_layout(df, layout["categories"], layout["num_groups"], data_year)
+        assert (layout["coordinates"] == X_reduced).all() and (layout["labels"] == labels).all()
+    assert len(entities) == len(layouts[0]["labels"])
+
+def test_batch_of_other_years(monkeypatch):
+    use_batch_cache_settings(monkeypatch)
+    _, layouts = compute_layouts(subsets[:1], years=[data_year - 1, data_year], workers=1)
+
+    assert get_base_matrix(app_data_processing.data_df_cached)["year_matrices"] is not None
+    assert [layout["year"] for layout in layouts] == [data_year - 1, data_year]
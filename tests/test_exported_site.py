@@ -0,0 +1,65 @@
+# Python modules
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# From local files
+from conftest import app_dir
+from app_export import export_site
+
+# Runs in the app directory given as argument (the code bundle or the repository app directory): loads the data and
+# renders the full table as the first client-side render does, then again after the summary columns are loaded
+render_script = """
+import asyncio, json, re, sys
+sys.path.insert(0, sys.argv[1])
+import app_data_processing, app_table_generation
+from app_variables import diagnoses_categories_map, data_source
+
+async def main():
+    await app_data_processing.train_and_get_plot(list(diagnoses_categories_map), 3)
+    first_table = app_table_generation.create_full_table()
+    await app_data_processing.load_table_data_async()
+    table = app_table_generation.create_full_table()
+    print(json.dumps({"data_source": data_source, "first_rows": first_table.count("<tr>"), "rows": table.count("<tr>"),
+                      "summary_rows": len(re.findall(r"row_heading level0 row[0-9]+ summary-row", table))}))
+
+asyncio.run(main())
+"""
+
+# Writes the files of the code bundle (app.json) to bundle_dir
+def extract_bundle(site_dir, bundle_dir):
+    for entry in json.loads((site_dir / "app.json").read_text()):
+        content = base64.b64decode(entry["content"]) if entry["type"] == "binary" else entry["content"].encode()
+        (bundle_dir / entry["name"]).write_bytes(content)
+
+def render_table(code_dir, env):
+    output = subprocess.run([sys.executable, "-c", render_script, str(code_dir)], cwd=code_dir, env={**os.environ, **env},
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+# The table of the exported site (summary columns loaded after the plot) has the same rows as the table of the app
+def test_assets_table_has_summary_rows(tmp_path):
+    site_dir, bundle_dir = tmp_path / "site", tmp_path / "bundle"
+    bundle_dir.mkdir()
+    export_site(site_dir, app_dir)
+    extract_bundle(site_dir, bundle_dir)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(SimpleHTTPRequestHandler, directory=str(site_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        env = {"APP_DISK_CACHE": "0", "APP_DATA_CACHE_DIR": str(tmp_path / "fetch_cache")}
+        assets = render_table(bundle_dir, {**env, "APP_DATA_ASSETS_URL": f"http://127.0.0.1:{server.server_port}/"})
+        local = render_table(app_dir, env)
+    finally:
+        server.shutdown()
+
+    assert assets["data_source"] == "assets" and local["data_source"] == "local"
+    assert assets["first_rows"] < assets["rows"]
+    assert assets["rows"] == local["rows"]
+    assert assets["summary_rows"] == local["summary_rows"] > 0
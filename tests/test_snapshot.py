@@ -0,0 +1,45 @@
+# Python modules
+import shutil
+import numpy as np
+import pandas as pd
+
+# From local files
+from conftest import app_dir
+from app_data_processing import get_columns_projection, read_csv_projected, get_base_matrix, fit_category_layout
+from app_layouts import enumerate_category_subsets, get_base_fingerprint, get_layouts_path, load_layouts
+from app_snapshot import build_snapshot, load_snapshot
+from app_variables import data_filename
+
+# Raw data of the bundled csv as read with and without a snapshot
+def load_csv_and_snapshot(tmp_path):
+    csv_path = tmp_path / data_filename
+    shutil.copy(app_dir / data_filename, csv_path)
+    columns = get_columns_projection()
+    return read_csv_projected(csv_path, columns), load_snapshot(build_snapshot(csv_path))[columns]
+
+def test_snapshot_has_csv_values(tmp_path):
+    df_csv, df_snapshot = load_csv_and_snapshot(tmp_path)
+    pd.testing.assert_frame_equal(df_snapshot, df_csv)
+
+# Every selection within one click of all or one category selected gives the same layout from the snapshot as from the csv,
+# and the bundled precomputed layouts are used with both
+def test_snapshot_layouts_match_csv(tmp_path):
+    layouts = {}
+    for name, df in zip(["csv", "snapshot"], load_csv_and_snapshot(tmp_path)):
+        base = get_base_matrix(df)
+        assert load_layouts(get_layouts_path(app_dir / data_filename), base) is not None
+        layouts[name] = (get_base_fingerprint(base), [fit_category_layout(df, subset) for subset in enumerate_category_subsets(1)])
+
+    assert layouts["snapshot"][0] == layouts["csv"][0]
+    for (X_snapshot, labels_snapshot), (X_csv, labels_csv) in zip(layouts["snapshot"][1], layouts["csv"][1]):
+        np.testing.assert_array_equal(X_snapshot, X_csv)
+        np.testing.assert_array_equal(labels_snapshot, labels_csv)
+
+# A float32 copy of the data (as in earlier snapshots) is not taken for the data the precomputed layouts were fitted on
+def test_fingerprint_uses_exact_values(tmp_path):
+    df_csv, _ = load_csv_and_snapshot(tmp_path)
+    df_float32 = df_csv.copy()
+    numeric_columns = df_float32.columns[2:]
+    df_float32[numeric_columns] = df_float32[numeric_columns].astype(np.float32).astype(np.float64)
+
+    assert get_base_fingerprint(get_base_matrix(df_float32)) != get_base_fingerprint(get_base_matrix(df_csv))
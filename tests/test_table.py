@@ -0,0 +1,36 @@
+# Python modules
+import pandas as pd
+
+# From local files
+from conftest import app_dir
+import app_data_processing
+import app_table_generation
+from app_data_processing import get_columns_projection, read_csv_projected, get_base_matrix
+from app_table_generation import is_client_side_table, create_table, create_full_table
+from app_variables import data_filename, entity_column, diagnoses_categories_map, client_side_table_max_entities
+
+# Raw data of the bundled csv with every entity copied, so that there are more entities than client_side_table_max_entities
+def get_many_entities_data():
+    df = read_csv_projected(app_dir / data_filename, get_columns_projection())
+    copies = client_side_table_max_entities // len(get_base_matrix(df)["countries"]) + 1
+    return pd.concat([df.assign(**{entity_column: df[entity_column] + f" ({copy})"}) for copy in range(copies)],
+                     ignore_index=True)
+
+def use_data(monkeypatch, df):
+    monkeypatch.setattr(app_data_processing, "data_df_cached", df)
+    monkeypatch.setattr(app_table_generation, "table_fragments_cached", None)
+
+def test_bundled_data_uses_client_side_table(monkeypatch):
+    use_data(monkeypatch, read_csv_projected(app_dir / data_filename, get_columns_projection()))
+    assert is_client_side_table()
+
+# Above client_side_table_max_entities only the selected entities are rendered, so the table sent does not grow with them
+def test_many_entities_use_server_rendered_table(monkeypatch):
+    df = get_many_entities_data()
+    use_data(monkeypatch, df)
+    assert not is_client_side_table()
+
+    countries = list(get_base_matrix(df)["countries"][entity_column][:3])
+    table = create_table(list(diagnoses_categories_map), countries, {}, rows_hidden_state=[])
+    assert table.count('class="col_heading level0') == len(countries)
+    assert len(table) * 10 < len(create_full_table())